@@ -1,27 +1,480 @@
 import tkinter as tk
-from tkinter import filedialog, messagebox
-import pygame
+from tkinter import filedialog, font as tkfont, messagebox, simpledialog, ttk
+import argparse
+import array
+import asyncio
+import atexit
+import collections
+import concurrent.futures
+import errno
+import heapq
+import importlib.util
+import io
+import itertools
+import json
+import math
+import mmap
+import multiprocessing
+import operator
 import os
+import queue
 import random
+import socket
+import sqlite3
+import struct
+import sys
+import threading
+import time
 from pathlib import Path
 
-# Node class for CDLL
-class SongNode:
-    def __init__(self, name, file_path):
+# pygame is the slowest import by far, it is loaded on first use (load_pygame)
+pygame = None
+pygame_lock = threading.Lock()
+
+def load_pygame():
+    # Safe from any thread, a host can start it in the background early on
+    global pygame
+    with pygame_lock:
+        if pygame is None:
+            started = time.perf_counter()
+            import pygame
+            metrics.record('startup.import_pygame', time.perf_counter() - started)
+    return pygame
+
+# MP3 frame header tables (MPEG version, layer) -> bitrate in kbps
+MP3_BITRATES = {
+    (1, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (1, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (1, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (2, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (2, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (2, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+MP3_SAMPLE_RATES = {
+    1: (44100, 48000, 32000),
+    2: (22050, 24000, 16000),
+    2.5: (11025, 12000, 8000),
+}
+# Bytes read to find the first frame and its Xing/VBRI tag, and how much
+# audio the fallback scan reads when there is no such tag
+MP3_HEAD_BYTES = 16 * 1024
+MP3_SCAN_BYTES = 256 * 1024
+
+def parse_frame_header(data, offset):
+    # Returns (frame_length, samples, sample_rate, bitrate, version, mono) or None
+    if offset + 4 > len(data) or data[offset] != 0xFF:
+        return None
+    b1, b2, b3 = data[offset + 1], data[offset + 2], data[offset + 3]
+    if b1 & 0xE0 != 0xE0:
+        return None
+    
+    version_bits = (b1 >> 3) & 3
+    layer = 4 - ((b1 >> 1) & 3)
+    bitrate_index = b2 >> 4
+    rate_index = (b2 >> 2) & 3
+    if version_bits == 1 or layer == 4 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    
+    version = {0: 2.5, 2: 2, 3: 1}[version_bits]
+    bitrate = MP3_BITRATES[(1 if version == 1 else 2, layer)][bitrate_index] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][rate_index]
+    padding = (b2 >> 1) & 1
+    
+    if layer == 1:
+        samples = 384
+        length = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        samples = 1152 if layer == 2 or version == 1 else 576
+        length = samples // 8 * bitrate // sample_rate + padding
+    
+    mono = (b3 >> 6) == 3
+    return length, samples, sample_rate, bitrate, version, mono
+
+def find_first_frame(data, offset=0):
+    # A header only counts if the next frame starts right where it ends
+    while True:
+        offset = data.find(b'\xff', offset)
+        if offset < 0:
+            return None
+        header = parse_frame_header(data, offset)
+        if header:
+            following = offset + header[0]
+            if following + 4 > len(data) or parse_frame_header(data, following):
+                return offset
+        offset += 1
+
+def id3v2_size(head):
+    if len(head) < 10 or head[:3] != b'ID3':
+        return 0
+    size = (head[6] << 21) | (head[7] << 14) | (head[8] << 7) | head[9]
+    footer = 10 if head[5] & 0x10 else 0
+    return 10 + size + footer
+
+def read_vbr_frames(data, offset, header):
+    # Frame count from a Xing/Info or VBRI tag in the first frame, if any
+    length, samples, sample_rate, bitrate, version, mono = header
+    if version == 1:
+        side_info = 17 if mono else 32
+    else:
+        side_info = 9 if mono else 17
+    
+    xing = offset + 4 + side_info
+    if data[xing:xing + 4] in (b'Xing', b'Info'):
+        flags = int.from_bytes(data[xing + 4:xing + 8], 'big')
+        if flags & 1 and len(data) >= xing + 12:
+            return int.from_bytes(data[xing + 8:xing + 12], 'big')
+    
+    vbri = offset + 4 + 32
+    if data[vbri:vbri + 4] == b'VBRI' and len(data) >= vbri + 18:
+        return int.from_bytes(data[vbri + 14:vbri + 18], 'big')
+    return None
+
+def read_mp3_duration(file_path):
+    # Track length in seconds from the frame headers, without decoding any audio
+    try:
+        with open(file_path, 'rb') as f:
+            file_size = os.fstat(f.fileno()).st_size
+            audio_start = id3v2_size(f.read(10))
+            audio_end = file_size
+            if file_size - audio_start >= 128:
+                f.seek(file_size - 128)
+                if f.read(3) == b'TAG':
+                    audio_end -= 128
+            
+            # Most encoders write a Xing/Info tag, which only needs the first frame
+            f.seek(audio_start)
+            data = f.read(MP3_HEAD_BYTES)
+            offset = find_first_frame(data)
+            if offset is None:
+                return None
+            header = parse_frame_header(data, offset)
+            frames = read_vbr_frames(data, offset, header)
+            if frames:
+                return frames * header[1] / header[2]
+            data += f.read(MP3_SCAN_BYTES - len(data))
+    except OSError:
+        return None
+    
+    # No VBR tag: walk the frames we have and extrapolate from their average rate
+    limit = min(len(data), audio_end - audio_start)
+    first = offset
+    seconds = 0.0
+    while header and offset + header[0] <= limit:
+        seconds += header[1] / header[2]
+        offset += header[0]
+        header = parse_frame_header(data, offset)
+    
+    scanned = offset - first
+    if scanned <= 0:
+        return None
+    if offset >= audio_end - audio_start:
+        return seconds
+    return seconds * (audio_end - audio_start - first) / scanned
+
+# Byte offset of every audio frame in an MP3, so a time maps exactly to the
+# frame that starts there, however much the bitrate varies
+class FrameIndex:
+    def __init__(self, offsets, samples, sample_rate):
+        self.offsets = offsets
+        self.samples = samples
+        self.sample_rate = sample_rate
+    
+    @classmethod
+    def build(cls, data):
+        offset = find_first_frame(data, id3v2_size(data))
+        if offset is None:
+            return None
+        header = parse_frame_header(data, offset)
+        samples, sample_rate = header[1], header[2]
+        if read_vbr_frames(data, offset, header) is not None:
+            # The Xing/Info/VBRI frame holds no audio
+            offset += header[0]
+            header = parse_frame_header(data, offset)
+        
+        offsets = array.array('Q')
+        while header:
+            offsets.append(offset)
+            offset += header[0]
+            header = parse_frame_header(data, offset)
+        return cls(offsets, samples, sample_rate) if offsets else None
+    
+    def locate(self, seconds):
+        # (byte offset, exact start time) of the frame playing at seconds
+        frame = int(seconds * self.sample_rate / self.samples)
+        frame = max(0, min(frame, len(self.offsets) - 1))
+        return self.offsets[frame], frame * self.samples / self.sample_rate
+
+# Latency histogram with log-scale buckets, 8 per doubling (about 9% wide),
+# so it takes constant memory however many samples go in
+class Histogram:
+    __slots__ = ('count', 'total', 'max', 'buckets')
+    
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = {}
+    
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        micros = seconds * 1e6
+        bucket = int(math.log2(micros) * 8) + 1 if micros > 1 else 0
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+    
+    def percentile(self, fraction):
+        # Upper edge of the bucket holding that share of the samples
+        rank = fraction * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(2 ** (bucket / 8) / 1e6, self.max)
+        return self.max
+
+# Timer for a with-block, a plain class so entering and leaving cost almost nothing
+class Timer:
+    __slots__ = ('metrics', 'name', 'start')
+    
+    def __init__(self, metrics, name):
+        self.metrics = metrics
         self.name = name
-        self.file_path = file_path
+    
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc):
+        self.metrics.record(self.name, time.perf_counter() - self.start)
+
+# Named timers and counters for the hot paths, shared by every thread
+class Metrics:
+    def __init__(self):
+        self.histograms = {}
+        self.counters = collections.Counter()
+        self.lock = threading.Lock()
+    
+    def timer(self, name):
+        return Timer(self, name)
+    
+    def record(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(seconds)
+    
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+    
+    def snapshot(self):
+        # Milliseconds, rounded for reading
+        with self.lock:
+            timers = {
+                name: {
+                    'count': h.count,
+                    'mean_ms': round(h.total / h.count * 1000, 3),
+                    'p50_ms': round(h.percentile(0.50) * 1000, 3),
+                    'p95_ms': round(h.percentile(0.95) * 1000, 3),
+                    'p99_ms': round(h.percentile(0.99) * 1000, 3),
+                    'max_ms': round(h.max * 1000, 3),
+                }
+                for name, h in sorted(self.histograms.items())
+            }
+            return {'timers': timers, 'counters': dict(sorted(self.counters.items()))}
+    
+    def dump(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.snapshot(), f, indent=2)
+            f.write('\n')
+
+metrics = Metrics()
+
+# Startup steps in the order they happen; pygame and the mixer come after the first frame
+STARTUP_STEPS = ('tk', 'engine', 'widgets', 'first_frame', 'restore', 'import_pygame', 'mixer_init')
+
+def startup_report():
+    # The startup.* timers as a short table, for --startup-report
+    timers = metrics.snapshot()['timers']
+    lines = ["Startup (ms):"]
+    for step in STARTUP_STEPS:
+        timer = timers.get(f"startup.{step}")
+        if timer:
+            lines.append(f"  {step:<14} {timer['max_ms']:>9.1f}")
+    return "\n".join(lines)
+
+# Track record: path, name and cached metadata, held once however many
+# playlists the song is in. Slotted and sharing folder strings so large libraries stay small
+class Track:
+    __slots__ = ('folder', 'filename', 'custom_name', 'duration', 'gain', 'plays', 'skips', 'favorite')
+    
+    def __init__(self, name, file_path):
+        folder, filename = os.path.split(file_path)
+        # Every song in a folder points at the same interned folder string
+        self.folder = sys.intern(folder)
+        self.filename = filename
+        # The name is normally the file's stem, only a different one is stored
+        self.custom_name = None if name == os.path.splitext(filename)[0] else name
+        # Length in seconds, read lazily from the MP3 headers (0 if unknown)
+        self.duration = None
+        # Loudness correction in dB from the analyzer, None until analyzed
+        self.gain = None
+        # Listening stats behind the weighted shuffle, persisted in the library index
+        self.plays = 0
+        self.skips = 0
+        self.favorite = False
+    
+    @classmethod
+    def restored(cls, folder, filename, custom_name, duration, gain, plays, skips, favorite):
+        # Bulk loading from a snapshot: fields as saved, no path splitting
+        track = cls.__new__(cls)
+        track.folder = folder
+        track.filename = filename
+        track.custom_name = custom_name
+        track.duration = duration
+        track.gain = gain
+        track.plays = plays
+        track.skips = skips
+        track.favorite = favorite
+        return track
+    
+    @property
+    def name(self):
+        if self.custom_name is not None:
+            return self.custom_name
+        return os.path.splitext(self.filename)[0]
+    
+    @property
+    def file_path(self):
+        return os.path.join(self.folder, self.filename)
+
+# Interning table for Track records, shared by all of an engine's playlists:
+# adding a path any playlist already holds reuses its record
+class TrackTable:
+    def __init__(self):
+        # folder -> {filename: Track}, keyed by the track's own strings
+        self.folders = {}
+    
+    def get(self, file_path):
+        folder, filename = os.path.split(file_path)
+        tracks = self.folders.get(folder)
+        return tracks.get(filename) if tracks else None
+    
+    def intern(self, name, file_path):
+        return self.intern_split(name, *os.path.split(file_path))
+    
+    def intern_split(self, name, folder, filename):
+        # For callers that split the path already, it is split once per song
+        tracks = self.folders.get(folder)
+        if tracks is None:
+            tracks = self.folders[sys.intern(folder)] = {}
+        else:
+            track = tracks.get(filename)
+            if track is not None:
+                return track
+        custom_name = None if name == os.path.splitext(filename)[0] else name
+        track = tracks[filename] = Track.restored(sys.intern(folder), filename, custom_name, None, None, 0, 0, False)
+        return track
+    
+    def adopt(self, track):
+        # Takes a ready-made record unless its path is already taken
+        tracks = self.folders.get(track.folder)
+        if tracks is None:
+            tracks = self.folders[track.folder] = {}
+        return tracks.setdefault(track.filename, track)
+    
+    def discard(self, file_paths):
+        for file_path in file_paths:
+            folder, filename = os.path.split(file_path)
+            tracks = self.folders.get(folder)
+            if tracks and tracks.pop(filename, None) and not tracks:
+                del self.folders[folder]
+    
+    def prune(self, playlists):
+        # Keeps only the records some playlist still holds
+        self.folders = {}
+        for playlist in playlists:
+            for node in playlist:
+                self.adopt(node.track)
+    
+    def __len__(self):
+        return sum(len(tracks) for tracks in self.folders.values())
+
+def track_field(name):
+    # Node attribute that reads and writes the node's shared Track
+    def set_field(node, value):
+        setattr(node.track, name, value)
+    return property(operator.attrgetter(f'track.{name}'), set_field)
+
+# Node class for CDLL: a playlist's links and positions around a shared Track
+class SongNode:
+    __slots__ = ('track', 'shuffle_pos', 'weight_pos', 'prev', 'next')
+    
+    folder = track_field('folder')
+    filename = track_field('filename')
+    custom_name = track_field('custom_name')
+    duration = track_field('duration')
+    gain = track_field('gain')
+    plays = track_field('plays')
+    skips = track_field('skips')
+    favorite = track_field('favorite')
+    name = property(operator.attrgetter('track.name'))
+    file_path = property(operator.attrgetter('track.file_path'))
+    
+    def __init__(self, track):
+        self.track = track
+        # Position in the playlist's shuffle order and in its weighted sampler
+        self.shuffle_pos = -1
+        self.weight_pos = -1
         self.prev = None
         self.next = None
 
 # CDLL for Playlist
 class CircularDoublyLinkedList:
-    def __init__(self):
+    def __init__(self, tracks=None):
+        # Track records, shared with the other playlists of the same engine
+        self.tracks = tracks if tracks is not None else TrackTable()
         self.head = None
         self.current = None
         self.size = 0
+        # Path index folder -> {filename: SongNode}, kept in sync by add/remove.
+        # Keys are the node's own strings, so the index adds no path copies
+        self.folders = {}
+        # Bumped whenever nodes leave or move, so cached positions can be checked;
+        # appending at the tail leaves every existing index as it was
+        self.version = 0
+        # Structures that follow membership changes (on_add / on_remove)
+        self.observers = []
+        self.shuffle = ShuffleEngine()
+        self.attach(self.shuffle)
+        # Songs to play next, ahead of the normal order
+        self.up_next = UpNextQueue()
+        self.attach(self.up_next)
+        # Built by the first search, then maintained incrementally
+        self.search_index = None
+        # Built when weighted shuffle is first switched on, kept in sync after that
+        self.weights = None
+    
+    def attach(self, observer):
+        self.observers.append(observer)
+        node = self.head
+        for _ in range(self.size):
+            observer.on_add(node)
+            node = node.next
     
     def add(self, name, file_path):
-        new_node = SongNode(name, file_path)
+        # A path is the node's identity, adding it twice returns the existing node
+        folder, filename = os.path.split(file_path)
+        songs = self.folders.get(folder)
+        existing = songs.get(filename) if songs else None
+        if existing:
+            return existing
+        
+        new_node = SongNode(self.tracks.intern_split(name, folder, filename))
         
         if not self.head:
             self.head = new_node
@@ -35,36 +488,251 @@ class CircularDoublyLinkedList:
             new_node.next = self.head
             self.head.prev = new_node
         
+        self._index(new_node)
         self.size += 1
+        for observer in self.observers:
+            observer.on_add(new_node)
         return new_node
     
-    def remove(self, name):
-        if not self.head:
+    def extend(self, songs):
+        # Links a whole batch of (name, path) pairs onto the tail in one pass.
+        # Returns a node per pair, the existing one for paths already present
+        nodes = []
+        first = last = None
+        count = 0
+        for name, file_path in songs:
+            folder, filename = os.path.split(file_path)
+            known = self.folders.get(folder)
+            node = known.get(filename) if known else None
+            if node is None:
+                node = SongNode(self.tracks.intern_split(name, folder, filename))
+                self._index(node)
+                if last is None:
+                    first = node
+                else:
+                    last.next = node
+                    node.prev = last
+                last = node
+                count += 1
+            nodes.append(node)
+        if first is None:
+            return nodes
+        
+        if self.head:
+            tail = self.head.prev
+        else:
+            self.head = first
+            self.current = first
+            tail = last
+        tail.next = first
+        first.prev = tail
+        last.next = self.head
+        self.head.prev = last
+        self.size += count
+        
+        node = first
+        for _ in range(count):
+            for observer in self.observers:
+                observer.on_add(node)
+            node = node.next
+        return nodes
+    
+    def restore(self, nodes):
+        # Bulk load of fresh nodes into an empty list, linked in one pass; the
+        # nodes must have distinct paths and tracks from this list's table, as
+        # they do when they come from a snapshot
+        if self.head:
+            raise ValueError("restore needs an empty list")
+        if not nodes:
+            return
+        prev = nodes[-1]
+        for node in nodes:
+            self._index(node)
+            node.prev = prev
+            prev.next = node
+            prev = node
+        self.head = self.current = nodes[0]
+        self.size = len(nodes)
+        for observer in self.observers:
+            for node in nodes:
+                observer.on_add(node)
+    
+    def remove(self, file_path):
+        node = self.get(file_path)
+        if node is None:
             return False
         
-        temp = self.head
-        while True:
-            if temp.name == name:
-                if self.size == 1:
-                    self.head = None
-                    self.current = None
-                else:
-                    temp.prev.next = temp.next
-                    temp.next.prev = temp.prev
-                    
-                    if temp == self.head:
-                        self.head = temp.next
-                    if temp == self.current:
-                        self.current = temp.next
-                
-                self.size -= 1
-                return True
-            
-            temp = temp.next
-            if temp == self.head:
+        self._unindex(node)
+        self._unlink(node)
+        return True
+    
+    def remove_many(self, file_paths):
+        # One sweep over the paths, each node unlinked in O(1); returns how many went
+        removed = 0
+        for file_path in file_paths:
+            node = self.get(file_path)
+            if node is not None:
+                self._unindex(node)
+                self._unlink(node)
+                removed += 1
+        return removed
+    
+    def _index(self, node):
+        track = node.track
+        songs = self.folders.get(track.folder)
+        if songs is None:
+            songs = self.folders[track.folder] = {}
+        songs[track.filename] = node
+    
+    def _unindex(self, node):
+        track = node.track
+        songs = self.folders[track.folder]
+        del songs[track.filename]
+        if not songs:
+            del self.folders[track.folder]
+    
+    def get(self, file_path):
+        folder, filename = os.path.split(file_path)
+        songs = self.folders.get(folder)
+        return songs.get(filename) if songs else None
+    
+    def __contains__(self, file_path):
+        return self.get(file_path) is not None
+    
+    def __iter__(self):
+        # Walks the nodes from head without building a copy of the playlist
+        node = self.head
+        for _ in range(self.size):
+            yield node
+            node = node.next
+    
+    def window(self, start, count):
+        # Up to count nodes from start onwards, stopping where the ring wraps to head
+        node = start
+        while count > 0:
+            yield node
+            node = node.next
+            count -= 1
+            if node is self.head:
+                break
+    
+    def insert_after(self, anchor, name, file_path):
+        # New songs go in right after anchor (at the end without one)
+        node = self.add(name, file_path)
+        if anchor is not None and node is not anchor:
+            self.move_after(node, anchor)
+        return node
+    
+    def move_after(self, node, anchor):
+        self.move_range_after(node, node, anchor)
+    
+    def move_range_after(self, first, last, anchor):
+        # Relinks the run first..last (following next) behind anchor. The splice
+        # is O(1); the run is walked once to check that anchor isn't part of it
+        if anchor.next is None or first.next is None:
+            raise ValueError("song is not in the playlist")
+        holds_head = False
+        node = first
+        for _ in range(self.size):
+            if node is anchor:
+                raise ValueError("cannot move songs after one of themselves")
+            holds_head = holds_head or node is self.head
+            if node is last:
                 break
+            node = node.next
+        else:
+            raise ValueError("range end is not in the playlist")
+        if anchor.next is first:
+            return
+        
+        if holds_head:
+            self.head = last.next
+        first.prev.next = last.next
+        last.next.prev = first.prev
+        after = anchor.next
+        anchor.next = first
+        first.prev = anchor
+        last.next = after
+        after.prev = last
+        self.version += 1
+    
+    def sort(self, key, reverse=False):
+        # Stable natural merge sort over the links themselves: the ring is cut
+        # into already ordered runs which are merged pairwise until one is left.
+        # Nodes keep their identity, so current, the path index and the
+        # shuffle order all stay valid
+        if self.size < 2:
+            return
+        keys = {node: key(node) for node in self}
+        in_order = operator.ge if reverse else operator.le
+        
+        # Cut the ring into runs, each a chain ending in None
+        self.head.prev.next = None
+        runs = []
+        node = self.head
+        while node:
+            runs.append(node)
+            while node.next and in_order(keys[node], keys[node.next]):
+                node = node.next
+            run_end, node = node, node.next
+            run_end.next = None
+        
+        while len(runs) > 1:
+            merged = [self._merge(runs[i], runs[i + 1], keys, in_order) for i in range(0, len(runs) - 1, 2)]
+            if len(runs) % 2:
+                merged.append(runs[-1])
+            runs = merged
+        
+        # Restore the prev links and close the ring again
+        self.head = runs[0]
+        node = self.head
+        while node.next:
+            node.next.prev = node
+            node = node.next
+        node.next = self.head
+        self.head.prev = node
+        self.version += 1
+    
+    @staticmethod
+    def _merge(a, b, keys, in_order):
+        # Ties take from a, the earlier run, which keeps the sort stable
+        if in_order(keys[a], keys[b]):
+            first = tail = a
+            a = a.next
+        else:
+            first = tail = b
+            b = b.next
+        while a and b:
+            if in_order(keys[a], keys[b]):
+                tail.next = a
+                tail = a
+                a = a.next
+            else:
+                tail.next = b
+                tail = b
+                b = b.next
+        tail.next = a or b
+        return first
+    
+    def _unlink(self, node):
+        if self.size == 1:
+            self.head = None
+            self.current = None
+        else:
+            node.prev.next = node.next
+            node.next.prev = node.prev
+            
+            if node == self.head:
+                self.head = node.next
+            if node == self.current:
+                self.current = node.next
         
-        return False
+        node.prev = None
+        node.next = None
+        self.size -= 1
+        self.version += 1
+        for observer in self.observers:
+            observer.on_remove(node)
     
     def next_song(self):
         if self.current:
@@ -96,84 +764,3128 @@ class CircularDoublyLinkedList:
         return songs
     
     def get_random_song(self):
-        if self.size == 0:
+        node = self.shuffle.next()
+        if node:
+            self.current = node
+        return node
+    
+    def get_previous_random_song(self):
+        node = self.shuffle.previous()
+        if node:
+            self.current = node
+        return node
+    
+    def find_song(self, file_path):
+        node = self.get(file_path)
+        if node:
+            self.current = node
+        return node
+    
+    def search(self, query, limit=None):
+        if self.search_index is None:
+            self.search_index = SearchIndex()
+            self.attach(self.search_index)
+        return self.search_index.search(query, limit)
+    
+    def set_weighted(self, on):
+        # The staged pick belongs to the old mode, so it goes back first
+        self.shuffle.unstage()
+        if on and self.weights is None:
+            self.weights = WeightedSampler()
+            self.weights.build(self)
+            self.observers.append(self.weights)
+        self.shuffle.sampler = self.weights if on else None
+
+# Shuffle order: lazy Fisher-Yates over an indexed view of the playlist
+class ShuffleEngine:
+    def __init__(self, history_size=500):
+        # order[:drawn] has played this cycle, order[drawn:] is still pending;
+        # each node keeps its own index into order in node.shuffle_pos
+        self.order = []
+        self.drawn = 0
+        # Song drawn ahead of time by peek(), handed out by the next next()
+        self.staged = None
+        # Back/forward history of the songs actually played in shuffle mode. A
+        # removed song's entries are left behind dead (shuffle_pos -1) and
+        # skipped, and compacted away once as many songs went as it holds
+        self.history = []
+        self.history_pos = -1
+        self.history_size = history_size
+        self.removed = 0
+        # WeightedSampler to draw from instead of the no-repeat cycle, if set
+        self.sampler = None
+    
+    def on_add(self, node):
+        # New songs join the pending part, so they still play this cycle
+        node.shuffle_pos = len(self.order)
+        self.order.append(node)
+    
+    def on_remove(self, node):
+        if node is self.staged:
+            self.staged = None
+        i = node.shuffle_pos
+        if i < self.drawn:
+            # Keep the played block contiguous before dropping the node
+            self.drawn -= 1
+            self._swap(i, self.drawn)
+            i = self.drawn
+        node.shuffle_pos = -1
+        last = self.order.pop()
+        if last is not node:
+            self.order[i] = last
+            last.shuffle_pos = i
+        
+        self.removed += 1
+        if self.removed > len(self.history):
+            self.compact()
+    
+    def compact(self):
+        # Drops dead history entries; the position moves back past those at or
+        # before it, so it stays on the last song that actually played
+        history = []
+        history_pos = self.history_pos
+        for i, node in enumerate(self.history):
+            if node.shuffle_pos >= 0:
+                history.append(node)
+            elif i <= self.history_pos:
+                history_pos -= 1
+        self.history = history
+        self.history_pos = history_pos
+        self.removed = 0
+    
+    def _step(self, pos, step):
+        # Index of the nearest live history entry before (-1) or after (1) pos
+        pos += step
+        while 0 <= pos < len(self.history):
+            if self.history[pos].shuffle_pos >= 0:
+                return pos
+            pos += step
+        return None
+    
+    def restore(self, order, drawn, history, history_pos):
+        # State saved in a snapshot; ignored unless it covers exactly the current songs
+        if len(order) != len(self.order) or not 0 <= drawn <= len(order) or history_pos >= len(history):
+            return
+        self.order = order
+        for i, node in enumerate(order):
+            node.shuffle_pos = i
+        self.drawn = drawn
+        self.staged = None
+        self.history = history
+        self.history_pos = history_pos
+        self.removed = 0
+    
+    def _swap(self, i, j):
+        a, b = self.order[i], self.order[j]
+        self.order[i], self.order[j] = b, a
+        a.shuffle_pos = j
+        b.shuffle_pos = i
+    
+    def _draw(self):
+        size = len(self.order)
+        if size == 0:
             return None
+        last = self.history[self.history_pos] if self.history_pos >= 0 else None
+        if self.sampler:
+            # Weighted draws repeat songs freely, only never the one just played
+            return self.sampler.sample(exclude=last)
+        if self.drawn >= size:
+            # Cycle finished, everything becomes pending again
+            self.drawn = 0
         
-        random_index = random.randint(0, self.size - 1)
-        temp = self.head
-        for _ in range(random_index):
-            temp = temp.next
+        j = random.randrange(self.drawn, size)
+        if self.order[j] is last and size - self.drawn > 1:
+            # Never replay the song that just finished, pick among the others
+            k = random.randrange(self.drawn, size - 1)
+            j = k + 1 if k >= j else k
         
-        self.current = temp
-        return temp
+        self._swap(self.drawn, j)
+        self.drawn += 1
+        return self.order[self.drawn - 1]
     
-    def find_song(self, name):
-        if not self.head:
+    def _record(self, node):
+        del self.history[self.history_pos + 1:]
+        self.history.append(node)
+        if len(self.history) > self.history_size:
+            del self.history[0]
+        self.history_pos = len(self.history) - 1
+    
+    def next(self):
+        # Walk forward again after going back, otherwise draw a new song
+        pos = self._step(self.history_pos, 1)
+        if pos is not None:
+            self.history_pos = pos
+            return self.history[pos]
+        
+        node = self.staged or self._draw()
+        self.staged = None
+        if node:
+            self._record(node)
+        return node
+    
+    def peek(self):
+        # What next() will return, drawn now so it doesn't change in between
+        pos = self._step(self.history_pos, 1)
+        if pos is not None:
+            return self.history[pos]
+        if not self.staged:
+            self.staged = self._draw()
+        return self.staged
+    
+    def unstage(self):
+        # Put a peeked song that never played back into the pending part
+        if self.staged:
+            if self.sampler is None:
+                self.drawn -= 1
+                self._swap(self.staged.shuffle_pos, self.drawn)
+            self.staged = None
+    
+    def previous(self):
+        pos = self.history_pos
+        if pos >= 0 and self.history[pos].shuffle_pos < 0:
+            # Its song was removed, the last live entry before it counts as current
+            pos = self._step(pos, -1)
+            if pos is None:
+                return None
+        pos = self._step(pos, -1)
+        if pos is None:
             return None
+        self.history_pos = pos
+        return self.history[pos]
+    
+    def played(self, node):
+        # Songs picked by hand count as drawn so the cycle doesn't repeat them
+        if self.history_pos >= 0 and self.history[self.history_pos] is node:
+            return
         
-        temp = self.head
-        while True:
-            if temp.name == name:
-                self.current = temp
-                return temp
-            temp = temp.next
-            if temp == self.head:
+        if node is self.staged:
+            self.staged = None
+        else:
+            self.unstage()
+        i = node.shuffle_pos
+        if i < 0 or i >= len(self.order) or self.order[i] is not node:
+            return
+        if i >= self.drawn:
+            self._swap(i, self.drawn)
+            self.drawn += 1
+        self._record(node)
+
+# Weighted shuffle: weights favour songs that usually play to the end, and favourites
+SHUFFLE_MIN_WEIGHT = 10
+FAVORITE_BOOST = 3
+
+# Fenwick tree over per-song weights, so drawing a song and changing a weight
+# are both O(log n). Songs keep a fixed index (node.weight_pos); a removed song's
+# slot is taken over by the last one, like in ShuffleEngine
+class WeightedSampler:
+    def __init__(self):
+        self.nodes = []
+        self.weights = array.array('q')
+        # 1-based: tree[i] sums the weights at indexes (i - lowbit(i), i]
+        self.tree = array.array('q', [0])
+        self.total = 0
+    
+    @staticmethod
+    def weight(node):
+        # Share of plays that ran to the end, smoothed so unplayed songs start at 100
+        track = node.track
+        weight = max(SHUFFLE_MIN_WEIGHT, 100 * (track.plays - track.skips + 1) // (track.plays + 1))
+        return weight * FAVORITE_BOOST if track.favorite else weight
+    
+    def build(self, nodes):
+        # All nodes at once in O(n): each entry passes its sum up to its parent
+        for node in nodes:
+            node.weight_pos = len(self.nodes)
+            self.nodes.append(node)
+            self.weights.append(self.weight(node))
+        self.tree = array.array('q', [0])
+        self.tree.extend(self.weights)
+        size = len(self.nodes)
+        for i in range(1, size + 1):
+            parent = i + (i & -i)
+            if parent <= size:
+                self.tree[parent] += self.tree[i]
+        self.total = sum(self.weights)
+    
+    def on_add(self, node):
+        weight = self.weight(node)
+        node.weight_pos = len(self.nodes)
+        self.nodes.append(node)
+        self.weights.append(weight)
+        i = len(self.nodes)
+        self.tree.append(weight + self.prefix(i - 1) - self.prefix(i - (i & -i)))
+        self.total += weight
+    
+    def on_remove(self, node):
+        pos = node.weight_pos
+        node.weight_pos = -1
+        last = self.nodes.pop()
+        last_weight = self.weights.pop()
+        # Nothing else in the tree covers the last index, so it just goes
+        self.tree.pop()
+        self.total -= last_weight
+        if last is not node:
+            self.nodes[pos] = last
+            last.weight_pos = pos
+            self._add(pos, last_weight - self.weights[pos])
+            self.weights[pos] = last_weight
+    
+    def _add(self, pos, delta):
+        self.total += delta
+        i = pos + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+    
+    def prefix(self, count):
+        # Sum of the first count weights
+        total = 0
+        while count > 0:
+            total += self.tree[count]
+            count -= count & -count
+        return total
+    
+    def update(self, node):
+        # Call after a node's stats or favourite flag changed
+        pos = node.weight_pos
+        if pos < 0 or pos >= len(self.nodes) or self.nodes[pos] is not node:
+            return
+        weight = self.weight(node)
+        if weight != self.weights[pos]:
+            self._add(pos, weight - self.weights[pos])
+            self.weights[pos] = weight
+    
+    def find(self, target):
+        # Index whose cumulative range holds target, walking down the tree
+        pos = 0
+        step = 1 << (len(self.nodes).bit_length() - 1)
+        while step:
+            i = pos + step
+            if i < len(self.tree) and self.tree[i] <= target:
+                pos = i
+                target -= self.tree[i]
+            step >>= 1
+        return pos
+    
+    def sample(self, exclude=None):
+        if not self.nodes:
+            return None
+        # Leaving out one song: draw over the total without it, then step over its range
+        gap = 0
+        pos = exclude.weight_pos if exclude is not None else -1
+        if len(self.nodes) > 1 and 0 <= pos < len(self.nodes) and self.nodes[pos] is exclude:
+            gap = self.weights[pos]
+        target = random.randrange(self.total - gap)
+        if gap and target >= self.prefix(pos):
+            target += gap
+        return self.nodes[self.find(target)]
+
+# Search index: trigram postings over lowercased song names, kept in sync
+# through on_add / on_remove like the shuffle engine
+class SearchIndex:
+    def __init__(self):
+        # Lowercased name per live node, and trigram -> list of nodes containing it.
+        # Lists are far smaller than sets; removed nodes stay in them as dead
+        # entries until there are enough to be worth compacting
+        self.names = {}
+        self.postings = collections.defaultdict(list)
+        self.dead = {}
+    
+    @staticmethod
+    def trigrams(text):
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+    
+    def on_add(self, node):
+        name = node.name.lower()
+        old = self.dead.pop(node, None)
+        self.names[node] = name
+        if old == name:
+            # Back in the playlist with its postings still in place
+            return
+        if old is not None:
+            for gram in self.trigrams(old):
+                self.postings[gram].remove(node)
+        postings = self.postings
+        for gram in self.trigrams(name):
+            postings[gram].append(node)
+    
+    def on_remove(self, node):
+        name = self.names.pop(node, None)
+        if name is None:
+            return
+        self.dead[node] = name
+        if len(self.dead) > max(1024, len(self.names)):
+            self.compact()
+    
+    def compact(self):
+        dead = self.dead
+        for gram in list(self.postings):
+            nodes = [node for node in self.postings[gram] if node not in dead]
+            if nodes:
+                self.postings[gram] = nodes
+            else:
+                del self.postings[gram]
+        self.dead = {}
+    
+    def search(self, query, limit=None):
+        # Ranked matches: name prefix, then word start, then anywhere in the name,
+        # then fuzzy matches sharing at least half of the query's trigrams
+        query = ' '.join(query.lower().split())
+        if not query:
+            return []
+        names = self.names
+        
+        grams = self.trigrams(query)
+        if grams:
+            # Only nodes holding every trigram of the query can contain it
+            candidates = set()
+            lists = sorted((self.postings.get(gram, ()) for gram in grams), key=len)
+            if lists[0]:
+                candidates.update(lists[0])
+                for nodes in lists[1:]:
+                    candidates.intersection_update(nodes)
+                    if not candidates:
+                        break
+            matches = [node for node in candidates if query in names.get(node, '')]
+        else:
+            # Too short for a trigram, check every name
+            matches = [node for node, name in names.items() if query in name]
+        
+        # Each tier is only worked out while the results still have room
+        word_start = ' ' + query
+        tiers = (
+            lambda name: name.startswith(query),
+            lambda name: word_start in name and not name.startswith(query),
+            lambda name: word_start not in name and not name.startswith(query),
+        )
+        results = []
+        by_name = lambda node: (len(names[node]), names[node])
+        for in_tier in tiers:
+            if limit is not None and len(results) >= limit:
                 break
-        return None
+            self.take(results, [node for node in matches if in_tier(names[node])], by_name, limit)
+        
+        if grams and (limit is None or len(results) < limit):
+            shared = collections.Counter()
+            for gram in grams:
+                shared.update(self.postings.get(gram, ()))
+            needed = max(1, (len(grams) + 1) // 2)
+            fuzzy = [
+                node for node, count in shared.items()
+                if count >= needed and node in names and query not in names[node]
+            ]
+            self.take(results, fuzzy, lambda node: (-shared[node],) + by_name(node), limit)
+        return results
+    
+    @staticmethod
+    def take(results, nodes, key, limit):
+        if limit is None:
+            results.extend(sorted(nodes, key=key))
+        elif len(results) < limit:
+            results.extend(heapq.nsmallest(limit - len(results), nodes, key=key))
+
+# Up-next queue: songs picked to play before the normal order resumes.
+# Follows the playlist as an observer so removed songs leave the queue too
+class UpNextQueue:
+    def __init__(self):
+        # (ticket, node) in play order. An entry is live while queued[node] is
+        # still its ticket, so membership and removal are O(1): a removed
+        # node's entry is left behind dead and skipped
+        self.songs = collections.deque()
+        self.queued = {}
+        self.tickets = itertools.count()
+    
+    def on_add(self, node):
+        pass
+    
+    def on_remove(self, node):
+        self.discard(node)
+    
+    def push(self, node):
+        ticket = next(self.tickets)
+        self.queued[node] = ticket
+        self.songs.append((ticket, node))
+        self.trim()
+    
+    def discard(self, node):
+        if self.queued.pop(node, None) is not None:
+            self.trim()
+    
+    def live(self, entry):
+        return self.queued.get(entry[1]) == entry[0]
+    
+    def trim(self):
+        # Dead entries go at once from either end, so peek and last stay O(1),
+        # and from the middle once they outnumber the live ones
+        while self.songs and not self.live(self.songs[0]):
+            self.songs.popleft()
+        while self.songs and not self.live(self.songs[-1]):
+            self.songs.pop()
+        if len(self.songs) > 2 * len(self.queued) + 32:
+            self.songs = collections.deque(entry for entry in self.songs if self.live(entry))
+    
+    def peek(self):
+        return self.songs[0][1] if self.songs else None
+    
+    def last(self):
+        return self.songs[-1][1] if self.songs else None
+    
+    def started(self, node):
+        # A queued song leaves the queue once it actually plays, wherever it was
+        self.discard(node)
+    
+    def clear(self):
+        self.songs.clear()
+        self.queued.clear()
+    
+    def __contains__(self, node):
+        return node in self.queued
+    
+    def __iter__(self):
+        return (node for ticket, node in self.songs if self.queued.get(node) == ticket)
+    
+    def __len__(self):
+        return len(self.queued)
 
-# Stack for Recently Played
+# Stack for Recently Played: a fixed-capacity ring buffer, so pushing onto a
+# full stack overwrites the oldest entry in O(1) instead of shifting the list
 class Stack:
-    def __init__(self, max_size=10):
-        self.items = []
+    def __init__(self, max_size=10, collapse_duplicates=False, log_path=None):
+        self.items = [None] * max_size
         self.max_size = max_size
+        # Slot of the oldest entry and how many slots are in use
+        self.start = 0
+        self.count = 0
+        # Skip a push that repeats the entry already on top
+        self.collapse_duplicates = collapse_duplicates
+        # Optional append-only log (one JSON line per push, null per pop),
+        # replayed and rewritten compactly when the stack is created
+        self.log_path = log_path
+        self.log = None
+        self.logged = 0
+        if log_path:
+            self.replay()
+            self.compact()
     
     def push(self, song):
-        if len(self.items) >= self.max_size:
-            self.items.pop(0)
-        self.items.append(song)
+        if self.collapse_duplicates and self.count and self.peek() == song:
+            return
+        self.append(song)
+        self.write(song)
+    
+    def append(self, song):
+        end = (self.start + self.count) % self.max_size
+        self.items[end] = song
+        if self.count == self.max_size:
+            self.start = (self.start + 1) % self.max_size
+        else:
+            self.count += 1
     
     def pop(self):
         if not self.is_empty():
-            return self.items.pop()
+            top = (self.start + self.count - 1) % self.max_size
+            song = self.items[top]
+            self.items[top] = None
+            self.count -= 1
+            self.write(None)
+            return song
         return None
     
     def peek(self):
         if not self.is_empty():
-            return self.items[-1]
+            return self.items[(self.start + self.count - 1) % self.max_size]
         return None
     
     def get_all(self):
-        return list(reversed(self.items))
+        # Newest first
+        return self.recent(self.count)
+    
+    def recent(self, count):
+        # The newest count entries, newest first
+        count = min(count, self.count)
+        return [self.items[(self.start + i) % self.max_size] for i in range(self.count - 1, self.count - 1 - count, -1)]
+    
+    def is_empty(self):
+        return self.count == 0
+    
+    def __len__(self):
+        return self.count
+    
+    def replay(self):
+        try:
+            with open(self.log_path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        song = json.loads(line)
+                    except ValueError:
+                        # A torn last line from a crash, everything before it is fine
+                        continue
+                    if song is None:
+                        if self.count:
+                            self.count -= 1
+                            self.items[(self.start + self.count) % self.max_size] = None
+                    elif not (self.collapse_duplicates and self.count and self.peek() == song):
+                        self.append(song)
+        except OSError:
+            pass
+    
+    def compact(self):
+        # Rewrite the log as just the current entries, oldest first
+        if self.log:
+            self.log.close()
+        os.makedirs(os.path.dirname(self.log_path) or '.', exist_ok=True)
+        temp_path = self.log_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            for song in reversed(self.get_all()):
+                f.write(json.dumps(song) + '\n')
+        os.replace(temp_path, self.log_path)
+        self.log = open(self.log_path, 'a', encoding='utf-8')
+        self.logged = self.count
+    
+    def write(self, song):
+        if not self.log:
+            return
+        self.log.write(json.dumps(song) + '\n')
+        self.log.flush()
+        self.logged += 1
+        # A long-running player compacts before the log outgrows the stack too far
+        if self.logged > 2 * self.max_size + 100:
+            self.compact()
+
+# Playlist files: extended M3U, read and written one entry at a time
+def read_m3u(playlist_path):
+    # Yields (name, path, duration); relative paths are relative to the playlist
+    base = os.path.dirname(os.path.abspath(playlist_path))
+    name = duration = None
+    with open(playlist_path, encoding='utf-8-sig', errors='surrogateescape') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('#EXTINF:'):
+                # #EXTINF:<seconds>,<title>, -1 when the length is unknown
+                length, _, name = line[8:].partition(',')
+                try:
+                    duration = float(length.split()[0]) if length.strip() else None
+                except ValueError:
+                    duration = None
+                if duration is not None and duration <= 0:
+                    duration = None
+                continue
+            if not line or line.startswith('#'):
+                continue
+            if '://' in line:
+                # Streams and URLs can't go through the library
+                name = duration = None
+                continue
+            
+            file_path = os.path.normpath(os.path.join(base, line))
+            yield (name or os.path.splitext(os.path.basename(file_path))[0], file_path, duration)
+            name = duration = None
+
+def write_m3u(playlist_path, songs):
+    # Written next to the target and swapped in, so a failed export leaves the old file
+    tmp_path = playlist_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8', errors='surrogateescape', newline='\n') as f:
+        f.write('#EXTM3U\n')
+        for song in songs:
+            length = round(song.duration) if song.duration else -1
+            f.write(f"#EXTINF:{length},{song.name}\n{song.file_path}\n")
+    os.replace(tmp_path, playlist_path)
+
+# Binary playlist snapshot: magic and header size, a JSON header, then the
+# track records and each playlist column by column. Strings are NUL-joined
+# UTF-8 and numbers raw arrays, so saving and loading are a few bulk passes
+# over a memory map. Playlists store track numbers, so shared songs are saved once
+SNAPSHOT_MAGIC = b'PYSICPL2'
+SNAPSHOT_PREFIX = struct.Struct('<8sI')
+
+def save_snapshot(snapshot_path, playlists, state):
+    # playlists: name -> CircularDoublyLinkedList, all over one TrackTable;
+    # state: JSON extras from the caller (active playlist, root folder, modes)
+    track_ids = {}
+    folder_ids = {}
+    folder_index = array.array('I')
+    filenames, names = [], []
+    durations, gains = array.array('d'), array.array('d')
+    plays, skips = array.array('I'), array.array('I')
+    favorites = bytearray()
+    entries, playlist_columns = [], []
+    for number, (playlist_name, playlist) in enumerate(playlists.items()):
+        index = {}
+        members = array.array('I')
+        for i, node in enumerate(playlist):
+            index[node] = i
+            track = node.track
+            track_id = track_ids.get(track)
+            if track_id is None:
+                track_id = track_ids[track] = len(track_ids)
+                folder_index.append(folder_ids.setdefault(track.folder, len(folder_ids)))
+                filenames.append(track.filename)
+                names.append(track.custom_name or '')
+                # NaN stands for "not known yet"
+                durations.append(math.nan if track.duration is None else track.duration)
+                gains.append(math.nan if track.gain is None else track.gain)
+                plays.append(track.plays)
+                skips.append(track.skips)
+                favorites.append(track.favorite)
+            members.append(track_id)
+        
+        shuffle = playlist.shuffle
+        # Only live history entries have an index
+        shuffle.compact()
+        order = array.array('I', [index[node] for node in shuffle.order])
+        drawn = shuffle.drawn
+        if shuffle.staged and shuffle.sampler is None:
+            # A peeked song that never played goes back to the pending part, as in unstage()
+            drawn -= 1
+            pos = shuffle.staged.shuffle_pos
+            order[pos], order[drawn] = order[drawn], order[pos]
+        
+        playlist_columns += [
+            (f'{number}.members', members.tobytes()),
+            (f'{number}.shuffle_order', order.tobytes()),
+            (f'{number}.shuffle_history', array.array('I', [index[node] for node in shuffle.history]).tobytes()),
+            (f'{number}.up_next', array.array('I', [index[node] for node in playlist.up_next if node in index]).tobytes()),
+        ]
+        entries.append({
+            'name': playlist_name,
+            'count': playlist.size,
+            'current': index.get(playlist.current, -1),
+            'drawn': drawn,
+            'history_pos': shuffle.history_pos,
+        })
+    
+    columns = [
+        ('folders', '\0'.join(folder_ids).encode('utf-8', 'surrogateescape')),
+        ('filenames', '\0'.join(filenames).encode('utf-8', 'surrogateescape')),
+        ('names', '\0'.join(names).encode('utf-8', 'surrogateescape')),
+        ('folder_index', folder_index.tobytes()),
+        ('durations', durations.tobytes()),
+        ('gains', gains.tobytes()),
+        ('plays', plays.tobytes()),
+        ('skips', skips.tobytes()),
+        ('favorites', bytes(favorites)),
+    ] + playlist_columns
+    header = dict(state)
+    header.update({
+        'version': 2,
+        'byteorder': sys.byteorder,
+        'tracks': len(track_ids),
+        'playlists': entries,
+        'columns': [[name, len(data)] for name, data in columns],
+    })
+    header_data = json.dumps(header).encode()
+    os.makedirs(os.path.dirname(snapshot_path) or '.', exist_ok=True)
+    tmp_path = snapshot_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(SNAPSHOT_PREFIX.pack(SNAPSHOT_MAGIC, len(header_data)))
+        f.write(header_data)
+        for name, data in columns:
+            f.write(data)
+    os.replace(tmp_path, snapshot_path)
+
+def load_snapshot(snapshot_path):
+    # (track table, {name: playlist}, header); ValueError if the file isn't a usable snapshot
+    with open(snapshot_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        if len(data) < SNAPSHOT_PREFIX.size:
+            raise ValueError("truncated snapshot")
+        magic, header_size = SNAPSHOT_PREFIX.unpack_from(data, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError("not a playlist snapshot")
+        offset = SNAPSHOT_PREFIX.size + header_size
+        header = json.loads(data[SNAPSHOT_PREFIX.size:offset])
+        if header.get('version') != 2 or header.get('byteorder') != sys.byteorder:
+            raise ValueError("snapshot from another version or machine")
+        columns = {}
+        for name, size in header['columns']:
+            columns[name] = data[offset:offset + size]
+            offset += size
+        if offset > len(data):
+            raise ValueError("truncated snapshot")
+    
+    count = header['tracks']
+    def strings(name):
+        return columns[name].decode('utf-8', 'surrogateescape').split('\0') if count else []
+    def numbers(name, typecode):
+        values = array.array(typecode)
+        values.frombytes(columns[name])
+        return values
+    
+    folders = [sys.intern(folder) for folder in strings('folders')]
+    folder_index = numbers('folder_index', 'I')
+    durations = numbers('durations', 'd')
+    gains = numbers('gains', 'd')
+    plays = numbers('plays', 'I')
+    skips = numbers('skips', 'I')
+    favorites = columns['favorites']
+    # The track table is filled per folder as the records are made
+    by_folder = [{} for _ in folders]
+    records = []
+    for folder, filename, name, duration, gain, play_count, skip_count, favorite in zip(
+        folder_index, strings('filenames'), strings('names'), durations, gains, plays, skips, favorites
+    ):
+        record = by_folder[folder][filename] = Track.restored(
+            folders[folder], filename, name or None,
+            None if duration != duration else duration,
+            None if gain != gain else gain,
+            play_count, skip_count, bool(favorite)
+        )
+        records.append(record)
+    if len(records) != count:
+        raise ValueError("truncated snapshot")
+    tracks = TrackTable()
+    tracks.folders = {folder: songs for folder, songs in zip(folders, by_folder) if songs}
+    
+    playlists = {}
+    for number, entry in enumerate(header['playlists']):
+        nodes = [SongNode(records[i]) for i in numbers(f'{number}.members', 'I')]
+        if len(nodes) != entry['count']:
+            raise ValueError("truncated snapshot")
+        playlist = CircularDoublyLinkedList(tracks)
+        playlist.restore(nodes)
+        if 0 <= entry['current'] < len(nodes):
+            playlist.current = nodes[entry['current']]
+        playlist.shuffle.restore(
+            [nodes[i] for i in numbers(f'{number}.shuffle_order', 'I')],
+            entry['drawn'],
+            [nodes[i] for i in numbers(f'{number}.shuffle_history', 'I')],
+            entry['history_pos']
+        )
+        for i in numbers(f'{number}.up_next', 'I'):
+            playlist.up_next.push(nodes[i])
+        playlists[entry['name']] = playlist
+    if not playlists:
+        raise ValueError("snapshot holds no playlist")
+    return tracks, playlists, header
+
+# Where Pysic keeps its library index and other state
+DATA_DIR = os.environ.get('PYSIC_HOME') or str(Path.home() / '.pysic')
+
+# On-disk library index (SQLite), one row per file keyed by path
+class LibraryIndex:
+    def __init__(self, db_path=None):
+        self.db_path = db_path or os.path.join(DATA_DIR, 'library.db')
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self.db = self.connect()
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS tracks (
+                path TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime INTEGER NOT NULL,
+                duration REAL
+            );
+            CREATE TABLE IF NOT EXISTS settings (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+            CREATE TABLE IF NOT EXISTS loudness (
+                path TEXT PRIMARY KEY,
+                mtime INTEGER NOT NULL,
+                rms_db REAL,
+                peak REAL,
+                gain_db REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS play_stats (
+                path TEXT PRIMARY KEY,
+                plays INTEGER NOT NULL,
+                skips INTEGER NOT NULL,
+                favorite INTEGER NOT NULL
+            );
+        """)
+    
+    def connect(self):
+        # sqlite3 connections are per thread, the scanner opens its own
+        return sqlite3.connect(self.db_path, timeout=10)
+    
+    def folder_range(self, folder_path):
+        # Every path under folder_path sorts between these two keys
+        prefix = os.path.join(folder_path, '')
+        return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    
+    def tracks(self, folder_path):
+        # Rows come back in the order they were first indexed, i.e. scan order
+        return self.db.execute(
+            "SELECT name, path, duration FROM tracks WHERE path >= ? AND path < ? ORDER BY rowid",
+            self.folder_range(folder_path)
+        ).fetchall()
+    
+    def stamps(self, db, folder_path):
+        rows = db.execute(
+            "SELECT path, size, mtime FROM tracks WHERE path >= ? AND path < ?",
+            self.folder_range(folder_path)
+        )
+        return {path: (size, mtime) for path, size, mtime in rows}
+    
+    def select_paths(self, db, query, paths):
+        # Runs query per batch of paths, its {} becomes the batch's placeholders
+        for start in range(0, len(paths), 500):
+            chunk = paths[start:start + 500]
+            yield from db.execute(query.format(', '.join('?' * len(chunk))), chunk)
+    
+    def file_stamps(self, db, paths):
+        # Point lookups for a few files, e.g. those of one changed folder
+        rows = self.select_paths(db, "SELECT path, size, mtime FROM tracks WHERE path IN ({})", paths)
+        return {path: (size, mtime) for path, size, mtime in rows}
+    
+    def file_durations(self, paths):
+        # Same as the folder lookups below, for files that can live anywhere
+        rows = self.select_paths(
+            self.db, "SELECT path, duration FROM tracks WHERE duration IS NOT NULL AND path IN ({})", paths
+        )
+        return dict(rows)
+    
+    def file_gains(self, paths):
+        rows = self.select_paths(
+            self.db,
+            "SELECT loudness.path, loudness.gain_db FROM loudness JOIN tracks "
+            "ON tracks.path = loudness.path AND tracks.mtime = loudness.mtime "
+            "WHERE loudness.path IN ({})",
+            paths
+        )
+        return dict(rows)
+    
+    def file_play_stats(self, paths):
+        return list(self.select_paths(
+            self.db, "SELECT path, plays, skips, favorite FROM play_stats WHERE path IN ({})", paths
+        ))
+    
+    def save(self, db, records):
+        # Upsert keeps the rowid, so changed files keep their place in the order
+        with db:
+            db.executemany(
+                "INSERT INTO tracks (path, name, size, mtime, duration) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET name = excluded.name, size = excluded.size, "
+                "mtime = excluded.mtime, duration = excluded.duration",
+                records
+            )
+    
+    def delete(self, db, paths):
+        with db:
+            db.executemany("DELETE FROM tracks WHERE path = ?", ((path,) for path in paths))
+    
+    def set_duration(self, file_path, duration):
+        with self.db:
+            self.db.execute("UPDATE tracks SET duration = ? WHERE path = ?", (duration, file_path))
+    
+    def gains(self, folder_path):
+        # Loudness results only count while the file still has the mtime they were measured at
+        rows = self.db.execute(
+            "SELECT loudness.path, loudness.gain_db FROM loudness JOIN tracks "
+            "ON tracks.path = loudness.path AND tracks.mtime = loudness.mtime "
+            "WHERE loudness.path >= ? AND loudness.path < ?",
+            self.folder_range(folder_path)
+        )
+        return dict(rows)
+    
+    def unanalyzed(self, db, folder_path):
+        return db.execute(
+            "SELECT tracks.path, tracks.mtime FROM tracks LEFT JOIN loudness "
+            "ON loudness.path = tracks.path AND loudness.mtime = tracks.mtime "
+            "WHERE tracks.path >= ? AND tracks.path < ? AND loudness.path IS NULL "
+            "ORDER BY tracks.rowid",
+            self.folder_range(folder_path)
+        ).fetchall()
+    
+    def save_loudness(self, db, records):
+        with db:
+            db.executemany(
+                "INSERT OR REPLACE INTO loudness (path, mtime, rms_db, peak, gain_db) VALUES (?, ?, ?, ?, ?)",
+                records
+            )
+    
+    def play_stats(self, folder_path):
+        # Kept by path alone, so stats survive the file being retagged
+        return self.db.execute(
+            "SELECT path, plays, skips, favorite FROM play_stats WHERE path >= ? AND path < ?",
+            self.folder_range(folder_path)
+        ).fetchall()
+    
+    def save_play_stats(self, rows):
+        # (path, plays, skips, favorite) rows, written in one transaction
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO play_stats (path, plays, skips, favorite) VALUES (?, ?, ?, ?)",
+                rows
+            )
+    
+    def get_setting(self, key, default=None):
+        row = self.db.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+    
+    def set_setting(self, key, value):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
+
+# Seconds between two polls of a watched folder
+WATCH_INTERVAL = 2.0
+# Folders changed less than this long ago (ns) are listed again on the next poll
+WATCH_RACY_NS = 2 * 10 ** 9
+
+# Incremental folder scanner, diffs the tree against the library index on a worker thread
+class FolderScanner:
+    def __init__(self, folder_path, library, batch_size=500):
+        self.folder_path = folder_path
+        self.library = library
+        self.batch_size = batch_size
+        # (kind, items) changes for the UI thread, None marks the end:
+        #   ('add', [(name, path, duration)]), ('update', [(path, duration)]), ('remove', [path])
+        self.changes = queue.Queue()
+        self.cancelled = threading.Event()
+        # Folder -> (mtime_ns, MP3 file names, subfolders) as last listed,
+        # the starting point for a FolderWatcher
+        self.tree = {}
+        self.thread = threading.Thread(target=self.scan, daemon=True)
+    
+    def start(self):
+        self.thread.start()
+    
+    def cancel(self):
+        self.cancelled.set()
+    
+    def list_folder(self, folder):
+        # The mtime is read before listing, so a change made meanwhile shows up next time
+        mtime = os.stat(folder).st_mtime_ns
+        with os.scandir(folder) as it:
+            entries = sorted(it, key=lambda e: e.name.lower())
+        
+        files, subfolders = [], []
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subfolders.append(entry.path)
+                elif entry.name.lower().endswith('.mp3') and entry.is_file():
+                    files.append(entry)
+            except OSError:
+                continue
+        
+        if time.time_ns() - mtime < WATCH_RACY_NS:
+            # Changed just now: on filesystems with coarse timestamps another
+            # change in the same tick would keep this mtime, so look again
+            mtime = 0
+        self.tree[folder] = (mtime, frozenset(entry.name for entry in files), tuple(subfolders))
+        return files, subfolders
+    
+    def walk(self, root=None):
+        folders = [root or self.folder_path]
+        while folders and not self.cancelled.is_set():
+            folder = folders.pop()
+            try:
+                files, subfolders = self.list_folder(folder)
+            except OSError:
+                continue
+            yield from files
+            # Depth first, visiting subfolders in name order
+            folders.extend(reversed(subfolders))
+    
+    def scan(self):
+        db = self.library.connect()
+        try:
+            with metrics.timer('scan.total'):
+                self.diff(db)
+        finally:
+            db.close()
+            self.changes.put(None)
+    
+    def diff(self, db):
+        known = self.library.stamps(db, self.folder_path)
+        seen = set()
+        self.compare(db, self.walk(), known, seen)
+        # A cancelled walk hasn't seen everything, so it can't tell what was deleted
+        if self.cancelled.is_set():
+            return
+        
+        removed = [path for path in known if path not in seen]
+        if removed:
+            self.library.delete(db, removed)
+            self.changes.put(('remove', removed))
+    
+    def compare(self, db, entries, known, seen):
+        added, updated = [], []
+        for entry in entries:
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            seen.add(entry.path)
+            stamp = (stat.st_size, stat.st_mtime_ns)
+            old = known.get(entry.path)
+            if old == stamp:
+                continue
+            
+            # Only new or changed files get their headers read again
+            name = os.path.splitext(entry.name)[0]
+            with metrics.timer('scan.read_headers'):
+                duration = read_mp3_duration(entry.path)
+            metrics.count('scan.headers_read')
+            (added if old is None else updated).append((entry.path, name, stamp[0], stamp[1], duration))
+            if len(added) + len(updated) >= self.batch_size:
+                self.flush(db, added, updated)
+                added, updated = [], []
+        
+        self.flush(db, added, updated)
+    
+    def flush(self, db, added, updated):
+        if not added and not updated:
+            return
+        self.library.save(db, added + updated)
+        if added:
+            self.changes.put(('add', [(name, path, duration) for path, name, size, mtime, duration in added]))
+        if updated:
+            self.changes.put(('update', [(path, duration) for path, name, size, mtime, duration in updated]))
+
+# Watch mode: after a scan, polls the folder tree for changes. Each poll stats
+# every folder once and lists again only those whose mtime moved, so the work
+# beyond that follows what changed rather than the size of the library.
+# Changes use the scanner's queue format; wake() tells the host there are some
+class FolderWatcher(FolderScanner):
+    def __init__(self, folder_path, library, tree, interval=WATCH_INTERVAL, wake=None):
+        super().__init__(folder_path, library)
+        self.tree = tree
+        self.interval = interval
+        self.wake = wake
+        self.thread = threading.Thread(target=self.watch, daemon=True)
+    
+    def watch(self):
+        db = self.library.connect()
+        try:
+            while not self.cancelled.wait(self.interval):
+                self.poll(db)
+                if self.wake and not self.changes.empty():
+                    self.wake()
+        finally:
+            db.close()
+    
+    def poll(self, db):
+        changed = []
+        for folder, (mtime, names, subfolders) in self.tree.items():
+            try:
+                current = os.stat(folder).st_mtime_ns
+            except OSError:
+                current = None
+            if current != mtime:
+                changed.append(folder)
+        
+        # Parents first: a removed subfolder is dropped with its parent's listing
+        for folder in changed:
+            if folder in self.tree and not self.cancelled.is_set():
+                with metrics.timer('watch.refresh'):
+                    self.refresh(db, folder)
+        return changed
+    
+    def refresh(self, db, folder):
+        old_mtime, old_names, old_subfolders = self.tree.pop(folder)
+        try:
+            files, subfolders = self.list_folder(folder)
+        except OSError:
+            # The folder itself is gone
+            self.remove(db, self.forget(folder, old_names, old_subfolders))
+            return
+        
+        names = {entry.name for entry in files}
+        removed = [os.path.join(folder, name) for name in old_names if name not in names]
+        for subfolder in old_subfolders:
+            if subfolder not in subfolders and subfolder in self.tree:
+                removed += self.forget(subfolder, *self.tree.pop(subfolder)[1:])
+        self.remove(db, removed)
+        
+        # Files still here may have been replaced; new subfolders are walked whole
+        entries = list(files)
+        for subfolder in subfolders:
+            if subfolder not in old_subfolders:
+                entries.extend(self.walk(subfolder))
+        known = self.library.file_stamps(db, [entry.path for entry in entries])
+        self.compare(db, entries, known, set())
+    
+    def forget(self, folder, names, subfolders):
+        # Every file path under a vanished folder, dropping its subtree from the tree
+        removed = [os.path.join(folder, name) for name in names]
+        pending = list(subfolders)
+        while pending:
+            subfolder = pending.pop()
+            state = self.tree.pop(subfolder, None)
+            if state:
+                removed += [os.path.join(subfolder, name) for name in state[1]]
+                pending.extend(state[2])
+        return removed
+    
+    def remove(self, db, removed):
+        if removed:
+            self.library.delete(db, removed)
+            self.changes.put(('remove', removed))
+
+# In-memory cache of whole audio files, capped by bytes with LRU eviction.
+# A prefetch thread fills it with the songs likely to play next, so skipping
+# around loads from memory instead of waiting on the disk or the network
+class AudioCache:
+    def __init__(self, max_bytes=96 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.prefetched = 0
+        # Only the newest prefetch request matters, older ones are dropped
+        self.requests = queue.Queue()
+        self.worker = None
+    
+    def get(self, file_path):
+        with self.lock:
+            data = self.entries.get(file_path)
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(file_path)
+            return data
+    
+    def fits(self, size):
+        # Files that would push out most of the cache on their own aren't kept
+        return size <= self.max_bytes // 2
+    
+    def put(self, file_path, data):
+        if not self.fits(len(data)):
+            return
+        with self.lock:
+            old = self.entries.pop(file_path, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[file_path] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+    
+    def read(self, file_path):
+        # Cached bytes, or the file read now and cached for next time. None for
+        # a file too large to cache, which the mixer streams from its path instead
+        data = self.get(file_path)
+        if data is None:
+            if not self.fits(os.path.getsize(file_path)):
+                return None
+            with open(file_path, 'rb') as f:
+                data = f.read()
+            self.put(file_path, data)
+        return data
+    
+    def prefetch(self, file_paths):
+        if self.worker is None:
+            self.worker = threading.Thread(target=self.run, daemon=True)
+            self.worker.start()
+        self.requests.put(list(file_paths))
+    
+    def run(self):
+        while True:
+            file_paths = self.requests.get()
+            for file_path in file_paths:
+                if not self.requests.empty():
+                    # Superseded by a newer request
+                    break
+                with self.lock:
+                    if file_path in self.entries:
+                        self.entries.move_to_end(file_path)
+                        continue
+                try:
+                    if not self.fits(os.path.getsize(file_path)):
+                        continue
+                    with open(file_path, 'rb') as f:
+                        data = f.read(self.max_bytes // 2 + 1)
+                except OSError:
+                    continue
+                self.put(file_path, data)
+                self.prefetched += 1
+    
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'prefetched': self.prefetched,
+            'files': len(self.entries),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+        }
+
+# Background track loading: the worker does the file I/O and header parsing,
+# the engine thread picks the results up in pump() and starts only the newest
+class TrackLoader:
+    def __init__(self, cache):
+        self.cache = cache
+        self.requests = queue.Queue()
+        self.results = queue.Queue()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+    
+    def request(self, generation, song):
+        self.requests.put((generation, song, song.file_path, song.duration is None))
+    
+    def superseded(self):
+        return not self.requests.empty()
+    
+    def run(self):
+        while True:
+            request = self.requests.get()
+            # A burst of clicks leaves several requests behind, only the last one counts
+            while self.superseded():
+                request = self.requests.get_nowait()
+            generation, song, file_path, wants_duration = request
+            
+            try:
+                with metrics.timer('load.read'):
+                    data = self.cache.read(file_path)
+            except OSError as e:
+                self.results.put((generation, song, None, None, str(e)))
+                continue
+            if self.superseded():
+                continue
+            duration = read_mp3_duration(file_path) or 0 if wants_duration else None
+            self.results.put((generation, song, data, duration, None))
+
+# Loudness normalization: tracks are brought to this RMS level (dBFS) by
+# turning the mixer volume down, never so far up that the peak would clip
+LOUDNESS_TARGET_DB = -20.0
+# Decoded samples summed per step, bounds the float copy each step makes
+LOUDNESS_CHUNK = 1 << 20
+
+def init_analysis_worker():
+    # Analysis processes decode without a sound card and yield the CPU to playback
+    os.environ['SDL_AUDIODRIVER'] = 'dummy'
+    try:
+        os.nice(10)
+    except (AttributeError, OSError):
+        pass
+    load_pygame()
+    pygame.mixer.init(frequency=44100, size=-16, channels=2)
+
+def numpy_available():
+    # Only loudness analysis needs numpy, playback works without. It is looked
+    # up when analysis starts and imported by the worker processes alone
+    return importlib.util.find_spec('numpy') is not None
+
+def analyze_loudness(file_path):
+    # (rms_db, peak, gain_db) of a whole decoded track; runs in a worker process
+    import numpy
+    samples = pygame.sndarray.array(pygame.mixer.Sound(file_path)).reshape(-1)
+    if not samples.size:
+        return None
+    full_scale = float(-numpy.iinfo(samples.dtype).min)
+    
+    square_sum = 0.0
+    peak = 0.0
+    for start in range(0, samples.size, LOUDNESS_CHUNK):
+        chunk = samples[start:start + LOUDNESS_CHUNK].astype(numpy.float64)
+        square_sum += float(numpy.dot(chunk, chunk))
+        peak = max(peak, float(numpy.abs(chunk).max()))
+    
+    rms = math.sqrt(square_sum / samples.size) / full_scale
+    peak /= full_scale
+    rms_db = 20 * math.log10(max(rms, 1e-6))
+    gain_db = LOUDNESS_TARGET_DB - rms_db
+    if peak > 0:
+        gain_db = min(gain_db, -20 * math.log10(peak))
+    return rms_db, peak, gain_db
+
+# Background loudness analysis of a library folder: a coordinator thread feeds
+# the tracks without a current result to a process pool, one per core, and
+# reports gains back through a queue like the folder scanner does
+class LoudnessAnalyzer:
+    def __init__(self, folder_path, library, workers=None):
+        self.folder_path = folder_path
+        self.library = library
+        self.workers = workers or os.cpu_count() or 1
+        # Batches of (path, gain_db), then None once the analyzer is done
+        self.results = queue.Queue()
+        self.cancelled = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+    
+    def start(self):
+        self.thread.start()
+    
+    def cancel(self):
+        self.cancelled.set()
+    
+    def run(self):
+        db = self.library.connect()
+        try:
+            pending = self.library.unanalyzed(db, self.folder_path)
+            if pending:
+                self.analyze(db, pending)
+        finally:
+            db.close()
+            self.results.put(None)
+    
+    def analyze(self, db, pending):
+        # Spawned workers start clean instead of inheriting the player's SDL state
+        context = multiprocessing.get_context('spawn')
+        pool = concurrent.futures.ProcessPoolExecutor(
+            self.workers, mp_context=context, initializer=init_analysis_worker
+        )
+        jobs = iter(pending)
+        running = {}
+        try:
+            while not self.cancelled.is_set():
+                # A couple of tracks per worker in flight keeps cancelling quick
+                for file_path, mtime in jobs:
+                    running[pool.submit(analyze_loudness, file_path)] = (file_path, mtime)
+                    if len(running) >= 2 * self.workers:
+                        break
+                if not running:
+                    break
+                
+                done, _ = concurrent.futures.wait(
+                    running, timeout=0.5, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                records = []
+                for future in done:
+                    file_path, mtime = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception:
+                        # Undecodable files get no gain, and aren't retried until they change
+                        result = None
+                    rms_db, peak, gain_db = result or (None, None, 0.0)
+                    records.append((file_path, mtime, rms_db, peak, gain_db))
+                if records:
+                    self.library.save_loudness(db, records)
+                    self.results.put([(record[0], record[4]) for record in records])
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+# Where control clients connect by default
+DEFAULT_SOCKET = os.path.join(DATA_DIR, 'pysic.sock')
+# Seconds between a playlist change and the snapshot being saved
+AUTOSAVE_DELAY = 30
+# Name of the playlist a fresh engine starts with
+DEFAULT_PLAYLIST = "Main"
+
+# Playback engine with no GUI: owns the playlist, the history stack and the mixer
+class PlayerEngine:
+    def __init__(self, library=None, history_size=1000, cache_bytes=96 * 1024 * 1024, background_loads=False):
+        # The mixer starts with the first song (init_mixer), so startup never
+        # waits for pygame or the sound device
+        self.mixer_ready = False
+        self.end_event = None
+        
+        # Data structures: named playlists over one table of track records,
+        # each with its own cursor, shuffle order and up-next queue
+        self.tracks = TrackTable()
+        self.playlist = CircularDoublyLinkedList(self.tracks)
+        self.playlist_name = DEFAULT_PLAYLIST
+        self.playlists = {self.playlist_name: self.playlist}
+        self.recently_played = Stack(
+            history_size,
+            collapse_duplicates=True,
+            log_path=os.path.join(DATA_DIR, 'history.log')
+        )
+        
+        # State variables
+        self.is_playing = False
+        self.is_paused = False
+        self.is_shuffle = False
+        self.is_gapless = True
+        self.current_song = None
+        self.queued_song = None
+        self.last_pos = 0
+        self.seek_offset = 0
+        
+        # Recent and upcoming files kept in memory, see prefetch()
+        self.cache = AudioCache(cache_bytes)
+        # With background loads, play_song only selects the song; the file is
+        # read on the loader thread and started from pump() unless a newer
+        # selection (higher generation) came in meanwhile
+        self.loader = TrackLoader(self.cache) if background_loads else None
+        self.load_generation = 0
+        self.pending_song = None
+        # When the song now loading was asked for, for the play.latency metric
+        self.requested_at = None
+        # Frame indexes of recently sought MP3s, built on a worker thread after
+        # the first seek into each; paths being indexed and finished results
+        self.frame_indexes = collections.OrderedDict()
+        self.indexing = set()
+        self.indexed = queue.Queue()
+        
+        # Library index on disk, restored on startup and rescanned incrementally
+        self.library = library or LibraryIndex()
+        self.library_root = None
+        # The playlist that mirrors library_root: scans, the watcher and the
+        # analyzer patch it, whichever playlist is showing
+        self.library_playlist = None
+        self.scanner = None
+        # Watch mode: after each scan a watcher keeps the playlist in step with the folder
+        self.watcher = None
+        self.watching = self.library.get_setting('watch', '0') == '1'
+        # Set by the host: called from worker threads when pump() has work waiting
+        self.wake = None
+        # Loudness analysis runs after each scan, when numpy is available
+        self.analyzer = None
+        self.volume = float(self.library.get_setting('volume', 1.0))
+        self.normalize = self.library.get_setting('normalize', '1') == '1'
+        # Shuffle draws by play/skip stats and favourites instead of uniformly
+        self.is_weighted = self.library.get_setting('weighted_shuffle', '0') == '1'
+        self.playlist.set_weighted(self.is_weighted)
+        
+        # Playlist snapshot, saved when dirty (autosave) and on exit
+        self.snapshot_path = os.path.join(DATA_DIR, 'playlist.bin')
+        self.dirty = False
+        # Tracks whose stats changed since the last save, by path
+        self.unsaved_stats = {}
+        # Settings that change in quick bursts, e.g. volume while its slider moves
+        self.unsaved_settings = {}
+        
+        # Clients such as the Tk window get (event, data) callbacks:
+        # track, state, mode, playlist, playlists, scan, stats, error
+        self.listeners = []
+    
+    @property
+    def up_next(self):
+        return self.playlist.up_next
+    
+    def init_mixer(self):
+        if self.mixer_ready:
+            return
+        load_pygame()
+        with metrics.timer('startup.mixer_init'):
+            pygame.mixer.init()
+        self.end_event = self.init_end_event()
+        self.mixer_ready = True
+        self.apply_volume()
+    
+    def warm_up(self, on_ready=None):
+        # Import pygame on a worker thread while the host draws its first frame;
+        # on_ready is called from that thread once the import is done
+        def run():
+            try:
+                load_pygame()
+            except ImportError:
+                # play_song reports it once a song is picked
+                return
+            if on_ready:
+                on_ready()
+        threading.Thread(target=run, daemon=True).start()
+    
+    def init_end_event(self):
+        # pygame only posts events with its video subsystem up, no window is needed
+        try:
+            if not pygame.display.get_init():
+                pygame.display.init()
+            end_event = pygame.USEREVENT + 1
+            pygame.mixer.music.set_endevent(end_event)
+            return end_event
+        except pygame.error:
+            return None
+    
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+    
+    def emit(self, event, **data):
+        if event in ('track', 'playlist', 'playlists', 'mode'):
+            # Something the playlist snapshot holds has changed
+            self.dirty = True
+        for listener in list(self.listeners):
+            listener(event, data)
+    
+    def restore(self):
+        # Last session's playlist as it was left, edits included; else the last folder
+        if self.restore_snapshot():
+            return
+        last_root = self.library.get_setting('root')
+        if last_root and os.path.isdir(last_root):
+            self.load(last_root)
+    
+    def restore_snapshot(self):
+        try:
+            with metrics.timer('load.snapshot'):
+                tracks, playlists, state = load_snapshot(self.snapshot_path)
+        except (OSError, ValueError, KeyError, IndexError, TypeError, struct.error):
+            # Missing, damaged or from another version: the folder is loaded instead
+            return False
+        
+        self.cancel_background()
+        self.stop()
+        self.tracks = tracks
+        self.playlists = playlists
+        active = state.get('active')
+        self.playlist_name = active if active in playlists else next(iter(playlists))
+        self.playlist = playlists[self.playlist_name]
+        root = state.get('root')
+        self.library_playlist = playlists.get(state.get('root_playlist'))
+        if self.library_playlist is None:
+            root = None
+        self.library_root = root
+        if root and not state.get('complete', True):
+            # The last scan was cut short, songs it had indexed may be missing
+            self.add_tracks(self.library.tracks(root), self.library_playlist)
+            self.apply_gains(self.library.gains(root).items())
+            self.apply_stats(self.library.play_stats(root))
+        self.playlist.set_weighted(self.is_weighted)
+        self.current_song = self.playlist.get_current()
+        self.is_shuffle = bool(state.get('shuffle'))
+        self.emit('track', song=self.current_song)
+        self.emit('playlists')
+        self.emit('playlist')
+        self.emit('mode')
+        self.dirty = False
+        
+        if root and os.path.isdir(root):
+            self.start_scan(root)
+        return True
+    
+    def replace_playlist(self, playlist):
+        # Stops playback and puts playlist in the active one's place. A folder
+        # scan patching the old list stops with it
+        if self.playlist is self.library_playlist:
+            self.cancel_background()
+            self.library_playlist = None
+            self.library_root = None
+        self.stop()
+        self.playlist = playlist
+        self.playlists[self.playlist_name] = playlist
+        # Records only the old list held go
+        self.prune_tracks()
+    
+    def prune_tracks(self):
+        # Unsaved stats go to the index first, a record that comes back later is a new one
+        self.flush_stats()
+        self.tracks.prune(self.playlists.values())
+    
+    def cancel_background(self):
+        # A scanner still running would patch the new playlist with the old folder
+        if self.scanner:
+            self.scanner.cancel()
+            self.scanner = None
+        if self.watcher:
+            self.watcher.cancel()
+            self.watcher = None
+        if self.analyzer:
+            self.analyzer.cancel()
+            self.analyzer = None
+    
+    def load(self, folder_path):
+        folder_path = os.path.abspath(folder_path)
+        if folder_path != self.library_root or self.playlist is not self.library_playlist:
+            # The folder moves to the active playlist; one it was in before keeps its songs
+            self.cancel_background()
+            self.replace_playlist(CircularDoublyLinkedList(self.tracks))
+            
+            # Warm start: everything the index already knows shows up at once
+            with metrics.timer('load.warm_start'):
+                self.add_tracks(self.library.tracks(folder_path))
+                self.apply_gains(self.library.gains(folder_path).items())
+                self.apply_stats(self.library.play_stats(folder_path))
+                self.playlist.set_weighted(self.is_weighted)
+            self.current_song = self.playlist.get_current()
+            self.library_root = folder_path
+            self.library_playlist = self.playlist
+            self.library.set_setting('root', folder_path)
+            self.emit('track', song=self.current_song)
+            self.emit('playlist')
+        else:
+            self.cancel_background()
+        self.start_scan(folder_path)
+    
+    def start_scan(self, folder_path):
+        # Rescan in the background and patch the playlist with what changed
+        self.scanner = FolderScanner(folder_path, self.library)
+        self.scanner.start()
+        self.emit('scan', songs=self.playlist.size, finished=False, cancelled=False)
+    
+    def import_playlist(self, playlist_path):
+        # The M3U's songs replace the playlist. They can live anywhere, so no
+        # folder is scanned for them; the index fills in what it knows
+        with metrics.timer('load.m3u'):
+            # Everything that can fail happens before the playlist changes, so an
+            # unreadable file leaves it alone. Only the listed files are looked up
+            entries = list(read_m3u(playlist_path))
+            paths = list(dict.fromkeys(file_path for name, file_path, duration in entries))
+            durations = self.library.file_durations(paths)
+            gains = self.library.file_gains(paths)
+            stats = self.library.file_play_stats(paths)
+            scanning = self.scanner is not None and self.playlist is self.library_playlist
+            self.replace_playlist(CircularDoublyLinkedList(self.tracks))
+            self.add_tracks(entries)
+            for file_path, duration in durations.items():
+                self.playlist.get(file_path).duration = duration
+            self.apply_gains(gains.items())
+            self.apply_stats(stats)
+            self.playlist.set_weighted(self.is_weighted)
+        self.current_song = self.playlist.get_current()
+        self.emit('track', song=self.current_song)
+        self.emit('playlist')
+        if scanning:
+            # The folder scan went with the old playlist
+            self.emit('scan', songs=self.playlist.size, finished=True, cancelled=True)
+        return self.playlist.size
+    
+    def export_playlist(self, playlist_path):
+        with metrics.timer('save.m3u'):
+            write_m3u(playlist_path, self.playlist)
+        return self.playlist.size
+    
+    def save(self):
+        # Snapshot of the playlist as it stands, restored on the next start
+        root_playlist = next(
+            (name for name, playlist in self.playlists.items() if playlist is self.library_playlist), None
+        )
+        state = {
+            'active': self.playlist_name,
+            'root': self.library_root,
+            'root_playlist': root_playlist,
+            'shuffle': self.is_shuffle,
+            # Songs of an unfinished scan may still be queued for the playlist
+            'complete': self.scanner is None,
+        }
+        self.flush_stats()
+        self.flush_settings()
+        with metrics.timer('save.snapshot'):
+            save_snapshot(self.snapshot_path, self.playlists, state)
+        self.dirty = False
+    
+    def flush_stats(self):
+        if self.unsaved_stats:
+            self.library.save_play_stats([
+                (track.file_path, track.plays, track.skips, int(track.favorite))
+                for track in self.unsaved_stats.values()
+            ])
+            self.unsaved_stats.clear()
+    
+    def flush_settings(self):
+        for key, value in list(self.unsaved_settings.items()):
+            self.library.set_setting(key, value)
+            del self.unsaved_settings[key]
+    
+    def autosave(self):
+        if self.dirty:
+            try:
+                self.save()
+            except (OSError, sqlite3.Error):
+                # Stays dirty, the next autosave tries again
+                pass
+    
+    def cancel_scan(self):
+        # Keeps the songs found so far, the scanner winds down on its end marker
+        if self.scanner:
+            self.scanner.cancel()
+    
+    def poll_scanner(self):
+        scanner = self.scanner
+        finished = False
+        try:
+            # Bounded work per pump so the host loop stays responsive
+            for _ in range(20):
+                change = scanner.changes.get_nowait()
+                if change is None:
+                    finished = True
+                    break
+                with metrics.timer('scan.apply'):
+                    self.apply_change(*change)
+        except queue.Empty:
+            pass
+        
+        if not self.current_song and self.playlist.size:
+            self.current_song = self.playlist.get_current()
+            self.emit('track', song=self.current_song)
+        if finished:
+            self.scanner = None
+            self.start_analysis()
+            if not scanner.cancelled.is_set():
+                self.start_watch(scanner.tree)
+        self.emit('playlist')
+        self.emit('scan', songs=self.playlist.size, finished=finished, cancelled=scanner.cancelled.is_set())
+    
+    def start_watch(self, tree):
+        # Picks up from the folder tree the scan just listed
+        if self.watching and self.library_root and not self.watcher:
+            self.watcher = FolderWatcher(self.library_root, self.library, tree, wake=self.notify)
+            self.watcher.start()
+    
+    def notify(self):
+        if self.wake:
+            self.wake()
+    
+    def set_watch(self, on):
+        self.watching = on
+        self.library.set_setting('watch', '1' if on else '0')
+        if not on and self.watcher:
+            self.watcher.cancel()
+            self.watcher = None
+        elif on and self.library_root and not self.scanner and not self.watcher:
+            # The watcher needs a fresh listing of the folder to start from
+            self.start_scan(self.library_root)
+        self.emit('mode')
+    
+    def poll_watcher(self):
+        kinds = set()
+        try:
+            for _ in range(20):
+                kind, items = self.watcher.changes.get_nowait()
+                with metrics.timer('watch.apply'):
+                    self.apply_change(kind, items)
+                kinds.add(kind)
+        except queue.Empty:
+            pass
+        if not kinds:
+            return
+        
+        if not self.current_song and self.playlist.size:
+            self.current_song = self.playlist.get_current()
+            self.emit('track', song=self.current_song)
+        if self.analyzer is None and kinds & {'add', 'update'}:
+            # New and changed files get their loudness measured
+            self.start_analysis()
+        self.emit('playlist')
+    
+    def start_analysis(self):
+        # Measures whatever in the library folder has no loudness result yet
+        if not self.library_root or not numpy_available():
+            return
+        self.analyzer = LoudnessAnalyzer(self.library_root, self.library)
+        self.analyzer.start()
+    
+    def poll_analyzer(self):
+        try:
+            while True:
+                gains = self.analyzer.results.get_nowait()
+                if gains is None:
+                    self.analyzer = None
+                    return
+                self.apply_gains(gains)
+        except queue.Empty:
+            pass
+    
+    def apply_gains(self, gains):
+        # Set on the shared records, so every playlist holding the song sees it
+        current = self.current_song.track if self.current_song else None
+        for file_path, gain in gains:
+            track = self.tracks.get(file_path)
+            if track:
+                track.gain = gain
+                if track is current and self.is_playing:
+                    self.apply_volume()
+    
+    def apply_volume(self, song=None):
+        # User volume times the track's loudness correction; the mixer caps at 1.0
+        song = song or self.current_song
+        level = self.volume
+        if self.normalize and song and song.gain is not None:
+            level *= 10 ** (song.gain / 20)
+        if self.mixer_ready:
+            pygame.mixer.music.set_volume(min(1.0, level))
+    
+    def set_volume(self, volume):
+        self.volume = min(1.0, max(0.0, volume))
+        # Saved with the playlist ('mode' marks it dirty), not on every slider step
+        self.unsaved_settings['volume'] = self.volume
+        self.apply_volume()
+        self.emit('mode')
+    
+    def set_normalize(self, on):
+        self.normalize = on
+        self.library.set_setting('normalize', '1' if on else '0')
+        self.apply_volume()
+        self.emit('mode')
+    
+    def apply_stats(self, rows):
+        for file_path, plays, skips, favorite in rows:
+            track = self.tracks.get(file_path)
+            # Stats not saved yet are newer than the index's
+            if track and file_path not in self.unsaved_stats:
+                track.plays = plays
+                track.skips = skips
+                track.favorite = bool(favorite)
+                self.update_weights(file_path)
+    
+    def save_stats(self, song):
+        # Written to the index with the next (auto)save, the snapshot holds them too
+        self.unsaved_stats[song.file_path] = song
+        self.dirty = True
+        self.update_weights(song.file_path)
+    
+    def update_weights(self, file_path):
+        # Stats are shared, the weighted samplers are per playlist
+        for playlist in self.playlists.values():
+            if playlist.weights:
+                node = playlist.get(file_path)
+                if node:
+                    playlist.weights.update(node)
+    
+    def set_favorite(self, song, on):
+        song.favorite = on
+        self.save_stats(song)
+        self.emit('stats', song=song)
+    
+    def set_weighted(self, on):
+        self.is_weighted = on
+        self.library.set_setting('weighted_shuffle', '1' if on else '0')
+        self.playlist.set_weighted(on)
+        self.refresh_queue()
+        self.emit('mode')
+    
+    def add_tracks(self, tracks, playlist=None):
+        # (name, path, duration) rows linked onto the playlist (the active one) as one batch
+        playlist = playlist or self.playlist
+        nodes = playlist.extend((name, file_path) for name, file_path, duration in tracks)
+        for node, track in zip(nodes, tracks):
+            # The record may be shared and already know better, e.g. an M3U's
+            # rounded #EXTINF length against the one read from the headers
+            if track[2] is not None and node.duration is None:
+                node.duration = track[2]
+    
+    def apply_change(self, kind, items):
+        # Changes found on disk: new files join the folder's playlist, changed
+        # and deleted ones affect every playlist holding them
+        if kind == 'add':
+            self.add_tracks(items, self.library_playlist)
+            # A file back in the folder picks up what the index kept for its path
+            paths = [file_path for name, file_path, duration in items]
+            self.apply_gains(self.library.file_gains(paths).items())
+            self.apply_stats(self.library.file_play_stats(paths))
+        elif kind == 'update':
+            for file_path, duration in items:
+                track = self.tracks.get(file_path)
+                if track:
+                    track.duration = duration
+                    # The file changed, its loudness gets measured again
+                    track.gain = None
+        elif kind == 'remove':
+            for playlist in self.playlists.values():
+                playlist.remove_many(items)
+            self.flush_stats()
+            self.tracks.discard(items)
+            # A playing song keeps playing, an idle cursor moves to a live node
+            if not self.is_playing and self.current_song and self.current_song.file_path not in self.playlist:
+                self.current_song = self.playlist.get_current()
+                self.emit('track', song=self.current_song)
+        self.refresh_queue()
+    
+    def add(self, file_path):
+        name = os.path.splitext(os.path.basename(file_path))[0]
+        node = self.playlist.add(name, file_path)
+        if not self.current_song:
+            self.current_song = self.playlist.get_current()
+            self.emit('track', song=self.current_song)
+        self.refresh_queue()
+        self.emit('playlist')
+        return node
+    
+    def enqueue(self, file_paths):
+        # Queued songs are spliced in behind the current song (or the last queued
+        # one), so the playlist shows them in the order they are going to play
+        for file_path in file_paths:
+            anchor = self.up_next.last() or self.current_song
+            if anchor is not None and anchor.next is None:
+                # The playing song was removed from the playlist
+                anchor = None
+            node = self.playlist.get(file_path)
+            if node is None:
+                name = os.path.splitext(os.path.basename(file_path))[0]
+                node = self.playlist.insert_after(anchor, name, file_path)
+            elif node is self.current_song or node in self.up_next:
+                continue
+            elif anchor is not None:
+                self.playlist.move_after(node, anchor)
+            self.up_next.push(node)
+        
+        if not self.current_song:
+            self.current_song = self.playlist.get_current()
+            self.emit('track', song=self.current_song)
+        self.refresh_queue()
+        self.emit('playlist')
+        return len(self.up_next)
+    
+    def sort(self, by='name', reverse=False):
+        if by == 'name':
+            key = lambda node: node.name.lower()
+        elif by == 'path':
+            key = lambda node: node.file_path
+        elif by == 'duration':
+            key = lambda node: node.duration or 0
+        elif by == 'mtime':
+            # Modification times come from the library index, not from the disk
+            stamps = self.library.stamps(self.library.db, self.library_root) if self.library_root else {}
+            key = lambda node: stamps.get(node.file_path, (0, 0))[1]
+        else:
+            raise ValueError(f"unknown sort order: {by}")
+        self.playlist.sort(key, reverse)
+        self.refresh_queue()
+        self.emit('playlist')
+    
+    def move(self, first, last, anchor):
+        self.playlist.move_range_after(first, last, anchor)
+        self.refresh_queue()
+        self.emit('playlist')
+    
+    def remove(self, file_path):
+        removed = self.playlist.remove(file_path)
+        if removed:
+            self.refresh_queue()
+            self.emit('playlist')
+        return removed
+    
+    def get_playlist(self, name):
+        playlist = self.playlists.get(name)
+        if playlist is None:
+            raise ValueError(f"no such playlist: {name}")
+        return playlist
+    
+    def check_playlist_name(self, name):
+        name = str(name).strip()
+        if not name:
+            raise ValueError("playlist name is empty")
+        if name in self.playlists:
+            raise ValueError(f"playlist already exists: {name}")
+        return name
+    
+    def create_playlist(self, name, file_paths=()):
+        # A new playlist over the shared track records; songs another playlist
+        # holds already are linked to the same record, not copied
+        name = self.check_playlist_name(name)
+        playlist = CircularDoublyLinkedList(self.tracks)
+        playlist.extend((os.path.splitext(os.path.basename(file_path))[0], file_path) for file_path in file_paths)
+        self.playlists[name] = playlist
+        self.emit('playlists')
+        return playlist
+    
+    def switch_playlist(self, name):
+        # O(1): each playlist keeps its cursor, shuffle order and queue while hidden
+        playlist = self.get_playlist(name)
+        if playlist is self.playlist:
+            return
+        self.stop()
+        self.playlist = playlist
+        self.playlist_name = name
+        # A playlist gets its weighted sampler the first time it is shown in that mode
+        playlist.set_weighted(self.is_weighted)
+        self.current_song = playlist.get_current()
+        self.emit('track', song=self.current_song)
+        self.emit('playlists')
+        self.emit('playlist')
+    
+    def rename_playlist(self, name, new_name):
+        self.get_playlist(name)
+        if new_name == name:
+            return
+        new_name = self.check_playlist_name(new_name)
+        # Rebuilt to keep the order playlists were made in
+        self.playlists = {new_name if key == name else key: playlist for key, playlist in self.playlists.items()}
+        if self.playlist_name == name:
+            self.playlist_name = new_name
+        self.emit('playlists')
+    
+    def delete_playlist(self, name):
+        playlist = self.get_playlist(name)
+        if len(self.playlists) == 1:
+            raise ValueError("the last playlist can't be deleted")
+        if playlist is self.playlist:
+            self.switch_playlist(next(other for other in self.playlists if other != name))
+        del self.playlists[name]
+        if playlist is self.library_playlist:
+            self.cancel_background()
+            self.library_playlist = None
+            self.library_root = None
+        self.prune_tracks()
+        self.emit('playlists')
+    
+    def add_to_playlist(self, name, file_paths):
+        # Adding to another playlist leaves playback alone
+        if name == self.playlist_name:
+            for file_path in file_paths:
+                self.add(file_path)
+            return self.playlist.size
+        playlist = self.get_playlist(name)
+        playlist.extend((os.path.splitext(os.path.basename(file_path))[0], file_path) for file_path in file_paths)
+        self.emit('playlists')
+        return playlist.size
+    
+    def playlist_info(self):
+        return [
+            {
+                'name': name,
+                'songs': playlist.size,
+                'active': playlist is self.playlist,
+                'folder': self.library_root if playlist is self.library_playlist else None,
+            }
+            for name, playlist in self.playlists.items()
+        ]
+    
+    def play_song(self, song):
+        if not song:
+            return False
+        try:
+            self.init_mixer()
+        except (ImportError, RuntimeError) as e:
+            # pygame missing or no sound device (pygame.error is a RuntimeError)
+            self.emit('error', message=f"Could not start audio: {str(e)}")
+            return False
+        self.requested_at = time.perf_counter()
+        if not self.loader:
+            return self.start_song(song, self.audio_source(song, self.read_audio(song)))
+        
+        # The selection shows up at once; what was playing stops, and the
+        # mixer only gets the song once the loader has read it
+        self.load_generation += 1
+        self.pending_song = song
+        self.loader.request(self.load_generation, song)
+        pygame.mixer.music.stop()
+        pygame.mixer.music.unload()
+        self.clear_end_events()
+        self.queued_song = None
+        self.is_playing = True
+        self.is_paused = False
+        self.select(song)
+        self.emit('track', song=song)
+        self.emit('state')
+        return True
+    
+    def start_song(self, song, source):
+        try:
+            # Stop current music before loading new
+            with metrics.timer('play.stop'):
+                pygame.mixer.music.stop()
+            with metrics.timer('play.unload'):
+                pygame.mixer.music.unload()
+            
+            # Load and play new song
+            with metrics.timer('play.load'):
+                pygame.mixer.music.load(*source)
+            self.apply_volume(song)
+            with metrics.timer('play.play'):
+                pygame.mixer.music.play()
+            self.clear_end_events()
+        except Exception as e:
+            metrics.count('play.errors')
+            self.requested_at = None
+            self.emit('error', message=f"Could not play song: {str(e)}")
+            return False
+        
+        self.is_playing = True
+        self.is_paused = False
+        self.song_started(song)
+        self.queue_next()
+        self.emit('state')
+        # From the click (or next/previous) to the mixer playing it
+        if self.requested_at is not None:
+            metrics.record('play.latency', time.perf_counter() - self.requested_at)
+            self.requested_at = None
+        metrics.count('play.started')
+        return True
+    
+    def poll_loader(self):
+        while True:
+            try:
+                generation, song, data, duration, error = self.loader.results.get_nowait()
+            except queue.Empty:
+                return
+            if generation != self.load_generation:
+                # Superseded by a newer selection or a stop
+                continue
+            
+            self.pending_song = None
+            if error:
+                metrics.count('play.errors')
+                self.requested_at = None
+                self.is_playing = False
+                self.emit('error', message=f"Could not play song: {error}")
+                self.emit('state')
+                continue
+            if duration is not None and song.duration is None:
+                song.duration = duration
+                self.library.set_duration(song.file_path, duration)
+            self.start_song(song, self.audio_source(song, data))
+    
+    def read_audio(self, song):
+        # Synchronous read through the cache, for engines without a loader thread
+        try:
+            return self.cache.read(song.file_path)
+        except OSError:
+            return None
+    
+    def audio_source(self, song, data):
+        # Arguments for mixer load/queue: the file's bytes, or the path itself
+        # when there are none (too large to cache, unreadable or not read yet)
+        if data is None:
+            return (song.file_path,)
+        return (io.BytesIO(data), os.path.splitext(song.filename)[1][1:].lower())
+    
+    def prefetch(self):
+        # Warm the cache with whatever is likely to be asked for next: the
+        # upcoming song, both neighbours and the songs played just before
+        song = self.current_song
+        if not song:
+            return
+        candidates = [self.upcoming_song(), song.next, song.prev]
+        file_paths = [node.file_path for node in candidates if node]
+        file_paths += [entry['path'] for entry in self.recently_played.recent(3)]
+        self.cache.prefetch(dict.fromkeys(path for path in file_paths if path != song.file_path))
+    
+    def select(self, song):
+        # Cursor bookkeeping, done as soon as a song is picked so that further
+        # next/previous clicks carry on from it even before it plays
+        self.current_song = song
+        self.playlist.current = song
+        if self.is_shuffle:
+            self.playlist.shuffle.played(song)
+        self.up_next.started(song)
+    
+    def song_started(self, song):
+        # Bookkeeping shared by start_song and the gapless handover
+        self.select(song)
+        self.recently_played.push({'name': song.name, 'path': song.file_path})
+        song.plays += 1
+        self.save_stats(song)
+        self.last_pos = 0
+        self.seek_offset = 0
+        
+        # Song length comes from the MP3 headers, cached on the node
+        if song.duration is None:
+            with metrics.timer('play.length_probe'):
+                song.duration = read_mp3_duration(song.file_path) or 0
+            self.library.set_duration(song.file_path, song.duration)
+        self.prefetch()
+        with metrics.timer('play.ui_update'):
+            self.emit('track', song=song)
+    
+    def upcoming_song(self):
+        # The song play_next would pick, without moving the cursor
+        if self.up_next:
+            return self.up_next.peek()
+        if self.is_shuffle:
+            return self.playlist.shuffle.peek()
+        current = self.playlist.get_current()
+        if current is not self.current_song:
+            # The playing song was removed and the cursor already moved on
+            return current
+        return current.next if current else None
+    
+    def queue_next(self):
+        # Gapless: hand the upcoming song to the mixer so it starts with no gap
+        self.queued_song = None
+        if not self.is_gapless or not self.is_playing or self.pending_song:
+            return
+        
+        song = self.upcoming_song()
+        if song:
+            # Runs on the UI thread at every track start: the bytes are used if
+            # the prefetch already has them, otherwise the mixer streams the file
+            source = self.audio_source(song, self.cache.get(song.file_path))
+            try:
+                pygame.mixer.music.queue(*source)
+                self.queued_song = song
+            except pygame.error:
+                pass
+    
+    def refresh_queue(self):
+        # Re-queue when a playlist edit or mode change moved the upcoming song
+        if self.is_gapless and self.is_playing and self.queued_song is not self.upcoming_song():
+            self.queue_next()
+    
+    def queued_song_started(self):
+        # The mixer already switched tracks, bring the cursor and history along
+        song = self.queued_song
+        self.queued_song = None
+        self.apply_volume(song)
+        if song.file_path in self.playlist:
+            self.song_started(song)
+        self.queue_next()
+    
+    def toggle_pause(self):
+        if self.is_playing and not self.is_paused:
+            self.pause()
+        elif self.is_paused:
+            self.resume()
+        else:
+            self.play_song(self.playlist.get_current())
+    
+    def pause(self):
+        if self.is_playing and not self.is_paused:
+            pygame.mixer.music.pause()
+            self.is_paused = True
+            self.emit('state')
+    
+    def resume(self):
+        if self.is_paused:
+            pygame.mixer.music.unpause()
+            self.is_paused = False
+            self.emit('state')
+    
+    def play_next(self, ended=False):
+        if self.playlist.size == 0:
+            return
+        
+        # Moving on from a song that was still playing counts as a skip
+        song = self.current_song
+        if not ended and self.is_playing and not self.pending_song and song and song.file_path in self.playlist:
+            song.skips += 1
+            self.save_stats(song)
+        
+        # The up-next queue goes first; a song that fails to play is dropped from it
+        song = self.up_next.peek()
+        if song:
+            if not self.play_song(song):
+                self.up_next.started(song)
+            return
+        
+        if self.is_shuffle:
+            with metrics.timer('shuffle.next'):
+                song = self.playlist.get_random_song()
+        else:
+            song = self.playlist.next_song()
+        
+        if song:
+            self.play_song(song)
+    
+    def play_previous(self):
+        if self.playlist.size == 0:
+            return
+        
+        # In shuffle mode go back to the song that actually played before
+        song = None
+        if self.is_shuffle:
+            song = self.playlist.get_previous_random_song()
+        if not song:
+            song = self.playlist.previous_song()
+        if song:
+            self.play_song(song)
+    
+    def stop(self):
+        # Also drops a load still in flight
+        self.load_generation += 1
+        self.pending_song = None
+        self.requested_at = None
+        if self.mixer_ready:
+            pygame.mixer.music.stop()
+            pygame.mixer.music.unload()
+            self.clear_end_events()
+        self.queued_song = None
+        self.is_playing = False
+        self.is_paused = False
+        self.seek_offset = 0
+        self.emit('state')
+    
+    def set_shuffle(self, on):
+        self.is_shuffle = on
+        if on:
+            # The playing song starts the shuffle history, so it isn't drawn again
+            if self.is_playing and self.current_song:
+                self.playlist.shuffle.played(self.current_song)
+        else:
+            self.playlist.shuffle.unstage()
+        self.refresh_queue()
+        self.emit('mode')
+    
+    def set_gapless(self, on):
+        self.is_gapless = on
+        if on:
+            self.queue_next()
+        else:
+            self.drop_queued()
+        self.emit('mode')
+    
+    def drop_queued(self):
+        # pygame can't take a queued track back, only stop() frees it: the
+        # playing song then picks up where it was, the same way a seek does
+        if not self.queued_song:
+            return
+        position = self.position()
+        self.queued_song = None
+        try:
+            pygame.mixer.music.stop()
+        except pygame.error:
+            return
+        self.clear_end_events()
+        self.seek(position)
+    
+    def seek(self, seconds):
+        if not self.is_playing or self.pending_song:
+            return
+        
+        song = self.current_song
+        seconds = max(0.0, seconds)
+        if song.duration:
+            seconds = min(seconds, song.duration)
+        try:
+            index, data = self.frame_index(song)
+            if index:
+                # Decode from the frame that holds the target time, which stays
+                # exact on VBR files where a bitrate-based jump would drift
+                offset, seconds = index.locate(seconds)
+                pygame.mixer.music.load(io.BytesIO(data[offset:]), 'mp3')
+                pygame.mixer.music.play()
+            else:
+                if song.file_path in self.frame_indexes:
+                    # An earlier exact seek may have left the mixer with a tail
+                    # of the file, start offsets count from the whole file
+                    pygame.mixer.music.load(song.file_path)
+                pygame.mixer.music.play(start=seconds)
+        except (pygame.error, OSError) as e:
+            self.emit('error', message=f"Could not seek: {str(e)}")
+            return
+        self.clear_end_events()
+        if self.is_paused:
+            pygame.mixer.music.pause()
+        # get_pos restarts from zero after play(), so remember where we jumped to
+        self.seek_offset = seconds
+        self.last_pos = 0
+        self.queue_next()
+    
+    def frame_index(self, song):
+        # (FrameIndex, file bytes) once both are in memory, else (None, None)
+        # and the seek uses the mixer's own start offset. Nothing is read or
+        # parsed here: a missing index is built in the background for next time
+        if not song.filename.lower().endswith('.mp3'):
+            return None, None
+        if song.file_path not in self.frame_indexes:
+            self.build_frame_index(song.file_path)
+            return None, None
+        index = self.frame_indexes[song.file_path]
+        self.frame_indexes.move_to_end(song.file_path)
+        data = self.cache.get(song.file_path)
+        if index is not None and data is None:
+            # Evicted since, the prefetch thread reads it back
+            self.cache.prefetch([song.file_path])
+        if index is None or data is None:
+            return None, None
+        return index, data
+    
+    def build_frame_index(self, file_path):
+        if file_path in self.indexing:
+            return
+        self.indexing.add(file_path)
+        def run():
+            # None for files too large to cache or without MP3 frames
+            try:
+                data = self.cache.read(file_path)
+                index = FrameIndex.build(data) if data is not None else None
+            except OSError:
+                index = None
+            self.indexed.put((file_path, index))
+            self.notify()
+        threading.Thread(target=run, daemon=True).start()
+    
+    def poll_indexes(self):
+        try:
+            while True:
+                file_path, index = self.indexed.get_nowait()
+                self.indexing.discard(file_path)
+                self.frame_indexes[file_path] = index
+                while len(self.frame_indexes) > 8:
+                    self.frame_indexes.popitem(last=False)
+        except queue.Empty:
+            pass
+    
+    def position(self):
+        pos = pygame.mixer.music.get_pos()
+        if pos < 0:
+            return self.seek_offset
+        return self.seek_offset + pos / 1000
+    
+    def clear_end_events(self):
+        # Stopping the mixer posts an end event too, drop it so it isn't taken for a track end
+        if self.end_event:
+            pygame.event.clear(self.end_event)
+    
+    def needs_pump(self):
+        # Hosts call pump() only while this is true, nothing wakes up when idle
+        return (
+            self.scanner is not None
+            or self.analyzer is not None
+            or (self.watcher is not None and not self.watcher.changes.empty())
+            or self.pending_song is not None
+            or bool(self.indexing)
+            or (self.is_playing and not self.is_paused)
+        )
+    
+    def pump(self):
+        if self.scanner:
+            self.poll_scanner()
+        if self.watcher:
+            self.poll_watcher()
+        if self.analyzer:
+            self.poll_analyzer()
+        if self.loader:
+            self.poll_loader()
+        if self.indexing:
+            self.poll_indexes()
+        if not self.is_playing or self.is_paused or self.pending_song:
+            # Nothing is in the mixer yet while a load is in flight
+            return
+        
+        try:
+            current_pos = pygame.mixer.music.get_pos() / 1000
+            if self.end_event:
+                for _ in pygame.event.get(self.end_event):
+                    self.track_ended()
+            elif not pygame.mixer.music.get_busy():
+                # No event support: poll the mixer instead
+                self.track_ended()
+            elif self.queued_song and current_pos < self.last_pos:
+                # get_pos restarts when the queued song takes over
+                self.track_ended()
+            else:
+                self.last_pos = current_pos
+        except pygame.error:
+            pass
+    
+    def track_ended(self):
+        if self.queued_song:
+            # Gapless: the mixer is already playing the queued song
+            self.queued_song_started()
+        elif self.is_playing:
+            self.play_next(ended=True)
+    
+    def describe(self, song):
+        if not song:
+            return None
+        return {
+            'name': song.name,
+            'path': song.file_path,
+            'duration': song.duration,
+            'plays': song.plays,
+            'skips': song.skips,
+            'favorite': song.favorite,
+        }
+    
+    def status(self):
+        if self.is_paused:
+            state = 'paused'
+        elif self.is_playing:
+            state = 'playing'
+        else:
+            state = 'stopped'
+        return {
+            'state': state,
+            'song': self.describe(self.current_song),
+            'position': round(self.position(), 3) if self.is_playing else 0,
+            'queued': self.describe(self.queued_song),
+            'up_next': [self.describe(song) for song in self.up_next],
+            'shuffle': self.is_shuffle,
+            'weighted': self.is_weighted,
+            'gapless': self.is_gapless,
+            'playlist': self.playlist_name,
+            'songs': self.playlist.size,
+            'folder': self.library_root,
+            'scanning': self.scanner is not None,
+            'watch': self.watching,
+            'watching': self.watcher is not None,
+            'analyzing': self.analyzer is not None,
+            'volume': self.volume,
+            'normalize': self.normalize,
+            'cache': self.cache.stats(),
+        }
+    
+    def handle(self, request):
+        # One control request {"cmd": ..., ...} -> {"ok": ..., "result"/"error": ...}
+        if not isinstance(request, dict):
+            # e.g. a batch entry that isn't an object
+            return {'ok': False, 'error': "bad request: expected a JSON object"}
+        try:
+            handler = getattr(self, f"command_{request.get('cmd')}", None)
+            if not handler:
+                raise ValueError(f"unknown command: {request.get('cmd')}")
+            response = {'ok': True, 'result': handler(request)}
+        except (ValueError, KeyError, TypeError, RuntimeError, OSError) as e:
+            # pygame.error is a RuntimeError, so mixer failures land here too
+            response = {'ok': False, 'error': str(e) or type(e).__name__}
+        
+        if 'id' in request:
+            response['id'] = request['id']
+        return response
+    
+    def command_batch(self, request):
+        return [self.handle(r) for r in request['commands']]
+    
+    def command_status(self, request):
+        return self.status()
+    
+    def command_stats(self, request):
+        return metrics.snapshot()
+    
+    def command_load(self, request):
+        self.load(request['path'])
+        return self.status()
+    
+    def command_import(self, request):
+        self.import_playlist(os.path.abspath(request['path']))
+        return self.status()
+    
+    def command_export(self, request):
+        return {'songs': self.export_playlist(os.path.abspath(request['path']))}
+    
+    def command_save(self, request):
+        self.save()
+        return {'songs': self.playlist.size, 'path': self.snapshot_path}
+    
+    def command_play(self, request):
+        if 'path' in request:
+            song = self.playlist.find_song(os.path.abspath(request['path']))
+            if not song:
+                raise ValueError(f"not in playlist: {request['path']}")
+            if not self.play_song(song):
+                raise RuntimeError(f"could not play: {song.file_path}")
+        elif self.is_paused:
+            self.resume()
+        elif not self.is_playing:
+            self.play_song(self.playlist.get_current())
+        return self.status()
+    
+    def command_pause(self, request):
+        self.pause()
+        return self.status()
+    
+    def command_stop(self, request):
+        self.stop()
+        return self.status()
+    
+    def command_next(self, request):
+        self.play_next()
+        return self.status()
+    
+    def command_prev(self, request):
+        self.play_previous()
+        return self.status()
+    
+    def command_seek(self, request):
+        self.seek(float(request['seconds']))
+        return self.status()
+    
+    def command_add(self, request):
+        paths = request['paths'] if 'paths' in request else [request['path']]
+        return self.add_to_playlist(
+            request.get('playlist', self.playlist_name),
+            [os.path.abspath(file_path) for file_path in paths]
+        )
+    
+    def command_enqueue(self, request):
+        paths = request['paths'] if 'paths' in request else [request['path']]
+        return self.enqueue([os.path.abspath(file_path) for file_path in paths])
+    
+    def command_sort(self, request):
+        self.sort(request.get('by', 'name'), bool(request.get('reverse', False)))
+        return self.status()
+    
+    def command_move(self, request):
+        # {"path": first, "to": last (optional), "after": anchor}
+        nodes = []
+        for file_path in (request['path'], request.get('to', request['path']), request['after']):
+            node = self.playlist.get(os.path.abspath(file_path))
+            if not node:
+                raise ValueError(f"not in playlist: {file_path}")
+            nodes.append(node)
+        self.move(*nodes)
+        return self.status()
+    
+    def command_remove(self, request):
+        return self.remove(os.path.abspath(request['path']))
+    
+    def command_playlists(self, request):
+        return self.playlist_info()
+    
+    def command_create(self, request):
+        # {"name": ..., "paths": [...]} or {"name": ..., "copy": true} for the showing playlist's songs
+        if request.get('copy'):
+            paths = [node.file_path for node in self.playlist]
+        else:
+            paths = [os.path.abspath(file_path) for file_path in request.get('paths', [])]
+        return self.create_playlist(request['name'], paths).size
+    
+    def command_switch(self, request):
+        self.switch_playlist(request['name'])
+        return self.status()
+    
+    def command_rename(self, request):
+        self.rename_playlist(request['name'], request['to'])
+        return self.playlist_info()
+    
+    def command_delete(self, request):
+        self.delete_playlist(request['name'])
+        return self.playlist_info()
+    
+    def command_shuffle(self, request):
+        self.set_shuffle(bool(request.get('on', not self.is_shuffle)))
+        return self.status()
+    
+    def command_weighted(self, request):
+        self.set_weighted(bool(request.get('on', not self.is_weighted)))
+        return self.status()
+    
+    def command_watch(self, request):
+        self.set_watch(bool(request.get('on', not self.watching)))
+        return self.status()
+    
+    def command_favorite(self, request):
+        if 'path' in request:
+            song = self.playlist.get(os.path.abspath(request['path']))
+            if not song:
+                raise ValueError(f"not in playlist: {request['path']}")
+        else:
+            song = self.current_song
+            if not song:
+                raise ValueError("no song selected")
+        self.set_favorite(song, bool(request.get('on', not song.favorite)))
+        return self.describe(song)
+    
+    def command_gapless(self, request):
+        self.set_gapless(bool(request.get('on', not self.is_gapless)))
+        return self.status()
+    
+    def command_volume(self, request):
+        self.set_volume(float(request['level']))
+        return self.status()
+    
+    def command_normalize(self, request):
+        self.set_normalize(bool(request.get('on', not self.normalize)))
+        return self.status()
+
+# JSON-lines control server on a Unix domain socket, one request per line
+class ControlServer:
+    def __init__(self, engine, socket_path=DEFAULT_SOCKET, call_soon=None):
+        self.engine = engine
+        self.socket_path = socket_path
+        # Runs a function on the engine's thread; None when the engine lives on the server loop
+        self.call_soon = call_soon
+        self.loop = None
+        self.pump_handle = None
+        self.save_handle = None
+    
+    async def serve(self):
+        # A socket left behind by a crash is replaced, one a player still answers on is not
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(self.socket_path)
+            except FileNotFoundError:
+                pass
+            except ConnectionRefusedError:
+                os.unlink(self.socket_path)
+            else:
+                raise OSError(errno.EADDRINUSE, "another player is listening on", self.socket_path)
+        self.loop = asyncio.get_running_loop()
+        if self.call_soon is None:
+            # A folder watcher has changes: pump from the server loop
+            self.engine.wake = lambda: self.loop.call_soon_threadsafe(self.schedule_pump)
+        server = await asyncio.start_unix_server(self.handle_client, path=self.socket_path)
+        async with server:
+            self.schedule_pump()
+            await server.serve_forever()
+    
+    def start_thread(self):
+        thread = threading.Thread(target=asyncio.run, args=(self.serve(),), daemon=True)
+        thread.start()
+        return thread
+    
+    async def handle_client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                
+                try:
+                    request = json.loads(line)
+                except ValueError as e:
+                    response = {'ok': False, 'error': f"bad request: {e}"}
+                else:
+                    try:
+                        response = await self.execute(request)
+                    except Exception as e:
+                        # A bug in one command still gets a reply, the client stays connected
+                        response = {'ok': False, 'error': f"internal error: {e!r}"}
+                
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+    
+    async def execute(self, request):
+        if self.call_soon is None:
+            response = self.engine.handle(request)
+            self.schedule_pump()
+            return response
+        
+        future = concurrent.futures.Future()
+        def run():
+            try:
+                future.set_result(self.engine.handle(request))
+            except BaseException as e:
+                future.set_exception(e)
+        self.call_soon(run)
+        return await asyncio.wrap_future(future)
+    
+    def schedule_pump(self):
+        # Headless: the server loop drives the engine, but only while it has work
+        if self.call_soon is not None:
+            return
+        if self.pump_handle is None and self.engine.needs_pump():
+            self.pump_handle = self.loop.call_later(0.1, self.pump)
+        if self.save_handle is None and self.engine.dirty:
+            self.save_handle = self.loop.call_later(AUTOSAVE_DELAY, self.autosave)
+    
+    def pump(self):
+        self.pump_handle = None
+        self.engine.pump()
+        self.schedule_pump()
+    
+    def autosave(self):
+        self.save_handle = None
+        self.engine.autosave()
+
+def send_request(socket_path, line):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(line.strip().encode() + b'\n')
+        return sock.makefile('rb').readline().decode().strip()
+
+# Virtualized playlist window: only the visible rows exist as Listbox lines,
+# filled from a windowed walk over the CDLL or from the ranked search results
+class PlaylistView:
+    def __init__(self, player):
+        self.player = player
+        self.engine = player.engine
+        # Index of the first visible song and the nodes shown, one per line
+        self.top = 0
+        self.rows = []
+        self.visible_rows = 15
+        # Last located (playlist, version, index, node), where walks continue from
+        self.anchor = None
+        self.refresh_job = None
+        # Ranked search results shown instead of the playlist, None to search again
+        self.matches = None
+        self.result_limit = 1000
+        
+        self.window = tk.Toplevel(player.root)
+        self.window.title("📜 Playlist")
+        self.window.geometry("600x400")
+        self.window.configure(bg="#1a1a2e")
+        # Closing only hides the window, it is reused the next time
+        self.window.protocol("WM_DELETE_WINDOW", self.hide)
+        
+        self.title = tk.Label(
+            self.window,
+            text="📜 Playlist",
+            font=("Arial", 14, "bold"),
+            bg="#1a1a2e",
+            fg="#e94560"
+        )
+        self.title.pack(pady=10)
+        
+        search_row = tk.Frame(self.window, bg="#1a1a2e")
+        search_row.pack(fill=tk.X, padx=20)
+        
+        self.query = tk.StringVar()
+        self.query.trace_add('write', self.on_query)
+        search_entry = tk.Entry(
+            search_row,
+            textvariable=self.query,
+            font=("Arial", 11),
+            bg="#16213e",
+            fg="#f1f1f1",
+            insertbackground="#f1f1f1"
+        )
+        search_entry.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        
+        # Sorting relinks the playlist in place, the view just redraws
+        self.sort_orders = {
+            "Name": ('name', False),
+            "Path": ('path', False),
+            "Newest": ('mtime', True),
+            "Longest": ('duration', True),
+        }
+        self.sort_by = ttk.Combobox(search_row, values=list(self.sort_orders), state="readonly", width=10)
+        self.sort_by.set("Sort by…")
+        self.sort_by.pack(side=tk.LEFT, padx=(10, 0))
+        self.sort_by.bind('<<ComboboxSelected>>', self.sort_playlist)
+        search_entry.bind('<Return>', self.play_first)
+        search_entry.bind('<Escape>', lambda event: self.query.set(""))
+        
+        frame = tk.Frame(self.window, bg="#16213e")
+        frame.pack(fill=tk.BOTH, expand=True, padx=20, pady=10)
+        
+        self.scrollbar = tk.Scrollbar(frame, command=self.on_scroll)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        
+        list_font = ("Arial", 11)
+        self.line_height = tkfont.Font(font=list_font).metrics('linespace') + 1
+        self.listbox = tk.Listbox(
+            frame,
+            font=list_font,
+            bg="#16213e",
+            fg="#f1f1f1",
+            selectbackground="#e94560",
+            selectforeground="white",
+            activestyle="none",
+            height=self.visible_rows
+        )
+        self.listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        
+        self.listbox.bind('<Configure>', self.on_resize)
+        self.listbox.bind('<Double-Button-1>', self.play_selected)
+        self.listbox.bind('<MouseWheel>', self.on_wheel)
+        self.listbox.bind('<Button-4>', self.on_wheel)
+        self.listbox.bind('<Button-5>', self.on_wheel)
+        
+        btn_frame = tk.Frame(self.window, bg="#1a1a2e")
+        btn_frame.pack(pady=10)
+        
+        buttons = [
+            ("⏭️ Play Next", self.queue_selected),
+            ("➕ Queue Results", self.queue_results),
+            ("🗑️ Remove Selected", self.remove_selected),
+        ]
+        for text, command in buttons:
+            btn = tk.Button(
+                btn_frame,
+                text=text,
+                command=command,
+                font=("Arial", 10, "bold"),
+                bg="#e94560",
+                fg="white",
+                cursor="hand2"
+            )
+            btn.pack(side=tk.LEFT, padx=5)
+    
+    def show(self):
+        self.window.deiconify()
+        self.window.lift()
+        self.render()
+    
+    def hide(self):
+        self.window.withdraw()
+    
+    def is_visible(self):
+        return self.window.winfo_viewable()
+    
+    def schedule_refresh(self):
+        # Many engine events can arrive in one pump, redraw once afterwards
+        self.matches = None
+        if self.refresh_job is None and self.is_visible():
+            self.refresh_job = self.window.after_idle(self.render)
+    
+    def locate(self, index):
+        # Walk to the node at index from whichever known node is closest:
+        # head, tail or the last located node if nothing shifted since
+        playlist = self.engine.playlist
+        if not 0 <= index < playlist.size:
+            return None
+        
+        node, steps = playlist.head, index
+        if playlist.size - 1 - index < steps:
+            node, steps = playlist.head.prev, index - playlist.size + 1
+        if self.anchor and self.anchor[0] is playlist and self.anchor[1] == playlist.version:
+            anchor_index, anchor_node = self.anchor[2], self.anchor[3]
+            if abs(index - anchor_index) < abs(steps):
+                node, steps = anchor_node, index - anchor_index
+        
+        while steps > 0:
+            node = node.next
+            steps -= 1
+        while steps < 0:
+            node = node.prev
+            steps += 1
+        
+        self.anchor = (playlist, playlist.version, index, node)
+        return node
+    
+    def render(self):
+        started = time.perf_counter()
+        self.refresh_job = None
+        playlist = self.engine.playlist
+        query = self.query.get().strip()
+        if query and self.matches is None:
+            self.matches = playlist.search(query, self.result_limit)
+        elif not query:
+            self.matches = None
+        
+        if self.matches is None:
+            self.title.config(text=f"📜 {self.engine.playlist_name} ({playlist.size} songs)")
+        else:
+            self.title.config(text=f"🔍 {len(self.matches)} of {playlist.size} songs")
+        
+        # Keep the selected song selected if it is still on screen
+        selected = self.selected_song()
+        size = self.size()
+        self.top = max(0, min(self.top, size - self.visible_rows))
+        if self.matches is not None:
+            self.rows = self.matches[self.top:self.top + self.visible_rows]
+        else:
+            start = self.locate(self.top)
+            self.rows = list(playlist.window(start, self.visible_rows)) if start else []
+        
+        self.listbox.delete(0, tk.END)
+        current = self.engine.current_song
+        for offset, song in enumerate(self.rows):
+            if song is current:
+                status = "▶️ "
+            elif song in self.engine.up_next:
+                status = "⏭️ "
+            else:
+                status = "   "
+            name = f"{song.name} ⭐" if song.favorite else song.name
+            if self.matches is None:
+                self.listbox.insert(tk.END, f"{status}{self.top + offset + 1}. {name}")
+            else:
+                self.listbox.insert(tk.END, f"{status}{name}")
+            if song is selected:
+                self.listbox.selection_set(offset)
+        
+        if size:
+            self.scrollbar.set(self.top / size, (self.top + len(self.rows)) / size)
+        else:
+            self.scrollbar.set(0, 1)
+        metrics.record('ui.playlist_render', time.perf_counter() - started)
+    
+    def size(self):
+        if self.matches is not None:
+            return len(self.matches)
+        return self.engine.playlist.size
+    
+    def on_query(self, *args):
+        # Every keystroke is one indexed search, results start from the top
+        self.matches = None
+        self.top = 0
+        self.render()
+    
+    def scroll_to(self, top):
+        top = max(0, min(top, self.size() - self.visible_rows))
+        if top != self.top:
+            self.top = top
+            self.render()
+    
+    def on_scroll(self, action, amount, unit=None):
+        if action == 'moveto':
+            self.scroll_to(int(float(amount) * self.size()))
+        elif action == 'scroll':
+            step = self.visible_rows if unit == 'pages' else 1
+            self.scroll_to(self.top + int(amount) * step)
+    
+    def on_wheel(self, event):
+        if event.num == 4 or event.delta > 0:
+            self.scroll_to(self.top - 3)
+        else:
+            self.scroll_to(self.top + 3)
+        return "break"
+    
+    def on_resize(self, event):
+        rows = max(1, event.height // self.line_height)
+        if rows != self.visible_rows:
+            self.visible_rows = rows
+            self.render()
+    
+    def selected_song(self):
+        selection = self.listbox.curselection()
+        if selection and selection[0] < len(self.rows):
+            return self.rows[selection[0]]
+        return None
+    
+    def play_selected(self, event):
+        song = self.selected_song()
+        if song:
+            self.engine.play_song(song)
+            self.hide()
+    
+    def play_first(self, event):
+        song = self.selected_song() or (self.rows[0] if self.rows else None)
+        if song:
+            self.engine.play_song(song)
+            self.hide()
+    
+    def sort_playlist(self, event):
+        by, reverse = self.sort_orders[self.sort_by.get()]
+        self.engine.sort(by, reverse)
+    
+    def queue_selected(self):
+        song = self.selected_song()
+        if song:
+            self.engine.enqueue([song.file_path])
+    
+    def queue_results(self):
+        # Everything the current search found, in ranked order
+        if self.matches:
+            self.engine.enqueue([song.file_path for song in self.matches])
     
-    def is_empty(self):
-        return len(self.items) == 0
+    def remove_selected(self):
+        song = self.selected_song()
+        if song and messagebox.askyesno("Remove Song", f"Remove '{song.name}' from playlist?"):
+            self.engine.remove(song.file_path)
+
+# Milliseconds between two checks for calls posted by worker threads
+CALL_POLL_MS = 50
 
-# Music Player Application
+# Music Player Application, a Tk client of the PlayerEngine
 class MusicPlayer:
-    def __init__(self, root):
+    def __init__(self, root, engine=None, startup_report=False):
+        started = time.perf_counter()
         self.root = root
         self.root.title("🎵 Music Player - Data Structures")
         self.root.geometry("900x700")
         self.root.configure(bg="#1a1a2e")
         
-        # Initialize pygame mixer
-        pygame.mixer.init()
+        # Playlist, history, mixer and library all live in the engine
+        self.engine = engine or PlayerEngine()
         
-        # Data structures
-        self.playlist = CircularDoublyLinkedList()
-        self.recently_played = Stack(10)
-        
-        # State variables
-        self.is_playing = False
-        self.is_paused = False
-        self.is_shuffle = False
-        self.current_song = None
+        # UI state
+        self.pump_job = None
+        self.save_job = None
+        self.shown_progress = None
+        self.announce_scan = False
+        self.playlist_view = None
+        # Other windows, also built on first use and reused after that
+        self.recent_window = None
+        self.stats_window = None
+        self.dragging = False
+        self.startup_report = startup_report
         
         # Create UI
-        self.create_widgets()
+        with metrics.timer('startup.widgets'):
+            self.create_widgets()
         
-        # Start update loop
-        self.update_progress()
+        # Worker threads never call Tk themselves, only a Tcl built with threads
+        # running its mainloop allows that. They post here, the Tk thread polls
+        self.calls = queue.Queue()
+        self.root.after(CALL_POLL_MS, self.run_calls)
+        
+        self.engine.subscribe(self.on_engine_event)
+        # Worker threads with changes for the playlist wake the pump up
+        self.engine.wake = lambda: self.call_soon(self.schedule_pump)
+        # The last session and audio are set up only once the window is on screen
+        self.root.after_idle(self.first_frame, started)
+    
+    def first_frame(self, started):
+        metrics.record('startup.first_frame', time.perf_counter() - started)
+        # The restore fills the empty window on the next idle round. pygame is
+        # imported on a worker thread meanwhile, then the mixer starts on the
+        # Tk thread, unless a song already started it
+        self.root.after_idle(self.restore)
+        self.engine.warm_up(on_ready=lambda: self.call_soon(self.audio_ready))
+    
+    def call_soon(self, fn):
+        # Runs fn on the Tk thread; safe from any thread
+        self.calls.put(fn)
+    
+    def run_calls(self):
+        try:
+            while True:
+                self.calls.get_nowait()()
+        except queue.Empty:
+            pass
+        finally:
+            self.root.after(CALL_POLL_MS, self.run_calls)
+    
+    def restore(self):
+        with metrics.timer('startup.restore'):
+            self.engine.restore()
+    
+    def audio_ready(self):
+        try:
+            self.engine.init_mixer()
+        except RuntimeError:
+            # No sound device; play_song reports it when a song is picked
+            pass
+        if self.startup_report:
+            print(startup_report(), file=sys.stderr)
     
     def create_widgets(self):
         # Title
@@ -216,6 +3928,104 @@ class MusicPlayer:
         )
         load_btn.pack(pady=10)
         
+        # M3U import and export
+        file_frame = tk.Frame(load_frame, bg="#16213e")
+        file_frame.pack(pady=(0, 10))
+        
+        import_btn = tk.Button(
+            file_frame,
+            text="📥 Import M3U",
+            command=self.import_playlist,
+            font=("Arial", 10),
+            bg="#0f3460",
+            fg="white",
+            cursor="hand2"
+        )
+        import_btn.pack(side=tk.LEFT, padx=5)
+        
+        export_btn = tk.Button(
+            file_frame,
+            text="📤 Export M3U",
+            command=self.export_playlist,
+            font=("Arial", 10),
+            bg="#0f3460",
+            fg="white",
+            cursor="hand2"
+        )
+        export_btn.pack(side=tk.LEFT, padx=5)
+        
+        self.watch_btn = tk.Button(
+            file_frame,
+            text="👁️ Watch Folder",
+            command=self.toggle_watch,
+            font=("Arial", 10),
+            bg="#e94560" if self.engine.watching else "#0f3460",
+            fg="white",
+            cursor="hand2"
+        )
+        self.watch_btn.pack(side=tk.LEFT, padx=5)
+        
+        # Named playlists: picking one switches to it as it was left
+        playlists_frame = tk.Frame(load_frame, bg="#16213e")
+        playlists_frame.pack(pady=(0, 10))
+        
+        playlists_label = tk.Label(
+            playlists_frame,
+            text="Playlist:",
+            font=("Arial", 10),
+            bg="#16213e",
+            fg="#a0a0a0"
+        )
+        playlists_label.pack(side=tk.LEFT, padx=5)
+        
+        self.playlist_choice = ttk.Combobox(playlists_frame, state="readonly", width=18)
+        self.playlist_choice.bind("<<ComboboxSelected>>", self.on_playlist_chosen)
+        self.playlist_choice.pack(side=tk.LEFT, padx=5)
+        
+        buttons = [
+            ("➕ New", self.new_playlist),
+            ("✏️ Rename", self.rename_playlist),
+            ("🗑️ Delete", self.delete_playlist),
+        ]
+        for text, command in buttons:
+            btn = tk.Button(
+                playlists_frame,
+                text=text,
+                command=command,
+                font=("Arial", 10),
+                bg="#0f3460",
+                fg="white",
+                cursor="hand2"
+            )
+            btn.pack(side=tk.LEFT, padx=5)
+        self.show_playlists()
+        
+        # Scan progress, only shown while a folder is being loaded
+        self.scan_frame = tk.Frame(load_frame, bg="#16213e")
+        
+        self.scan_label = tk.Label(
+            self.scan_frame,
+            text="",
+            font=("Arial", 9),
+            bg="#16213e",
+            fg="#a0a0a0"
+        )
+        self.scan_label.pack(side=tk.LEFT, padx=5)
+        
+        self.scan_bar = ttk.Progressbar(self.scan_frame, mode="indeterminate", length=200)
+        self.scan_bar.pack(side=tk.LEFT, padx=5)
+        
+        cancel_btn = tk.Button(
+            self.scan_frame,
+            text="✖ Cancel",
+            command=self.cancel_scan,
+            font=("Arial", 9),
+            bg="#0f3460",
+            fg="white",
+            cursor="hand2"
+        )
+        cancel_btn.pack(side=tk.LEFT, padx=5)
+        
         # Current Song Display
         song_frame = tk.Frame(self.root, bg="#16213e", bd=2, relief=tk.RAISED)
         song_frame.pack(pady=10, padx=20, fill=tk.X)
@@ -243,14 +4053,18 @@ class MusicPlayer:
         progress_frame = tk.Frame(song_frame, bg="#16213e")
         progress_frame.pack(pady=10, padx=20, fill=tk.X)
         
-        # Simple progress indicator (no slider to avoid UI jumps)
+        # Progress indicator moved by update_progress; click or drag on it to seek
         self.progress_canvas = tk.Canvas(
             progress_frame,
             height=6,
             bg="#0f3460",
-            highlightthickness=0
+            highlightthickness=0,
+            cursor="hand2"
         )
         self.progress_canvas.pack(fill=tk.X)
+        self.progress_canvas.bind('<Button-1>', self.drag_progress)
+        self.progress_canvas.bind('<B1-Motion>', self.drag_progress)
+        self.progress_canvas.bind('<ButtonRelease-1>', self.release_progress)
         
         # Create progress bar rectangle
         self.progress_rect = self.progress_canvas.create_rectangle(
@@ -363,6 +4177,77 @@ class MusicPlayer:
         )
         recent_btn.grid(row=0, column=1, padx=5)
         
+        self.gapless_btn = tk.Button(
+            list_frame,
+            text="⏩ Gapless",
+            command=self.toggle_gapless,
+            **button_style
+        )
+        self.gapless_btn.config(bg="#e94560")
+        self.gapless_btn.grid(row=0, column=2, padx=5)
+        
+        self.normalize_btn = tk.Button(
+            list_frame,
+            text="🎚️ Normalize",
+            command=self.toggle_normalize,
+            **button_style
+        )
+        self.normalize_btn.config(bg="#e94560" if self.engine.normalize else "#0f3460")
+        self.normalize_btn.grid(row=0, column=3, padx=5)
+        
+        stats_btn = tk.Button(
+            list_frame,
+            text="📊 Stats",
+            command=self.show_stats,
+            **button_style
+        )
+        stats_btn.grid(row=0, column=4, padx=5)
+        
+        self.weighted_btn = tk.Button(
+            list_frame,
+            text="⚖️ Smart",
+            command=self.toggle_weighted,
+            **button_style
+        )
+        self.weighted_btn.config(bg="#e94560" if self.engine.is_weighted else "#0f3460")
+        self.weighted_btn.grid(row=0, column=5, padx=5)
+        
+        self.favorite_btn = tk.Button(
+            list_frame,
+            text="⭐ Favorite",
+            command=self.toggle_favorite,
+            **button_style
+        )
+        self.favorite_btn.grid(row=0, column=6, padx=5)
+        
+        # Volume
+        volume_frame = tk.Frame(control_frame, bg="#16213e")
+        volume_frame.pack(pady=(0, 10))
+        
+        volume_label = tk.Label(
+            volume_frame,
+            text="🔊",
+            font=("Arial", 12),
+            bg="#16213e",
+            fg="#f1f1f1"
+        )
+        volume_label.pack(side=tk.LEFT)
+        
+        self.volume_scale = tk.Scale(
+            volume_frame,
+            from_=0,
+            to=100,
+            orient=tk.HORIZONTAL,
+            length=250,
+            showvalue=False,
+            bg="#16213e",
+            troughcolor="#0f3460",
+            highlightthickness=0,
+            command=self.change_volume
+        )
+        self.volume_scale.set(round(self.engine.volume * 100))
+        self.volume_scale.pack(side=tk.LEFT, padx=10)
+        
         # Info Section
         info_frame = tk.Frame(self.root, bg="#0f3460", bd=2, relief=tk.RAISED)
         info_frame.pack(pady=10, padx=20, fill=tk.BOTH, expand=True)
@@ -378,9 +4263,10 @@ class MusicPlayer:
         
         info_text = """
 • Circular Doubly Linked List - Playlist management with bidirectional traversal
-• Stack (LIFO) - Recently played songs tracking (max 10)
-• Randomization - Shuffle mode with random song selection
-        """
+• Stack (LIFO) - Recently played songs tracking (last {})
+• Shuffle Engine - No-repeat random order (lazy Fisher-Yates) with back/forward history
+• Fenwick Tree - Smart shuffle weighted by plays, skips and favorites in O(log n)
+        """.format(self.engine.recently_played.max_size)
         
         info_content = tk.Label(
             info_frame,
@@ -407,145 +4293,265 @@ class MusicPlayer:
         if not folder_path:
             return
         
-        # Clear existing playlist
-        self.playlist = CircularDoublyLinkedList()
-        self.stop()
-        
-        # Load all MP3 files
-        mp3_files = []
-        for file in os.listdir(folder_path):
-            if file.lower().endswith('.mp3'):
-                mp3_files.append(file)
-        
-        if not mp3_files:
-            messagebox.showwarning("No MP3 Files", "No MP3 files found in the selected folder!")
+        self.announce_scan = True
+        self.engine.load(folder_path)
+    
+    def cancel_scan(self):
+        self.engine.cancel_scan()
+        self.scan_label.config(text="Cancelling...")
+    
+    def import_playlist(self):
+        playlist_path = filedialog.askopenfilename(
+            title="Import Playlist",
+            filetypes=[("Playlists", "*.m3u *.m3u8"), ("All files", "*")]
+        )
+        if not playlist_path:
             return
+        try:
+            count = self.engine.import_playlist(playlist_path)
+        except (OSError, ValueError) as e:
+            messagebox.showerror("Error", f"Could not import playlist: {str(e)}")
+            return
+        messagebox.showinfo("Success", f"Imported {count} songs!")
+    
+    def export_playlist(self):
+        playlist_path = filedialog.asksaveasfilename(
+            title="Export Playlist",
+            defaultextension=".m3u8",
+            filetypes=[("Playlists", "*.m3u8 *.m3u")]
+        )
+        if not playlist_path:
+            return
+        try:
+            self.engine.export_playlist(playlist_path)
+        except OSError as e:
+            messagebox.showerror("Error", f"Could not export playlist: {str(e)}")
+    
+    def autosave(self):
+        self.save_job = None
+        self.engine.autosave()
+    
+    def on_engine_event(self, event, data):
+        # The window is one client of the engine, it only mirrors engine state
+        if event in ('track', 'playlist', 'stats') and self.playlist_view:
+            self.playlist_view.schedule_refresh()
         
-        # Add to playlist
-        for file in mp3_files:
-            file_path = os.path.join(folder_path, file)
-            song_name = os.path.splitext(file)[0]
-            self.playlist.add(song_name, file_path)
-        
-        self.current_song = self.playlist.get_current()
+        if event == 'track':
+            self.show_track(data['song'])
+        elif event == 'state':
+            self.show_state()
+        elif event == 'mode':
+            self.show_mode()
+        elif event == 'stats':
+            self.update_display()
+        elif event == 'playlist':
+            self.stats_label.config(text=f"Songs in Playlist: {self.engine.playlist.size}")
+        elif event == 'playlists':
+            self.show_playlists()
+        elif event == 'scan':
+            self.show_scan(data)
+        elif event == 'error':
+            messagebox.showerror("Error", data['message'])
+        self.schedule_pump()
+        if self.save_job is None and self.engine.dirty:
+            self.save_job = self.root.after(AUTOSAVE_DELAY * 1000, self.autosave)
+    
+    def show_track(self, song):
         self.update_display()
-        self.stats_label.config(text=f"Songs in Playlist: {self.playlist.size}")
+        self.shown_progress = None
+        self.progress_canvas.coords(self.progress_rect, 0, 0, 0, 6)
+        self.current_time_label.config(text="0:00")
+        if not song or not self.engine.is_playing:
+            self.total_time_label.config(text="0:00")
+        elif song.duration:
+            self.total_time_label.config(text=self.format_time(song.duration))
+        else:
+            self.total_time_label.config(text="--:--")
+    
+    def show_state(self):
+        if self.engine.is_playing and not self.engine.is_paused:
+            self.play_pause_btn.config(text="⏸️ Pause")
+        else:
+            self.play_pause_btn.config(text="▶️ Play")
         
-        messagebox.showinfo("Success", f"Loaded {len(mp3_files)} MP3 files!")
+        if not self.engine.is_playing:
+            self.current_time_label.config(text="0:00")
+            self.total_time_label.config(text="0:00")
+            # Reset progress bar
+            self.progress_canvas.coords(self.progress_rect, 0, 0, 0, 6)
+            self.shown_progress = None
     
-    def play_song(self, song):
-        if song:
-            try:
-                # Stop current music before loading new
-                pygame.mixer.music.stop()
-                pygame.mixer.music.unload()
-                
-                # Load and play new song
-                pygame.mixer.music.load(song.file_path)
-                pygame.mixer.music.play()
-                
-                self.is_playing = True
-                self.is_paused = False
-                self.current_song = song
-                self.recently_played.push({'name': song.name, 'path': song.file_path})
-                self.update_display()
-                self.play_pause_btn.config(text="⏸️ Pause")
-                
-                # Get and display song length once
-                try:
-                    song_length = pygame.mixer.Sound(song.file_path).get_length()
-                    self.total_time_label.config(text=self.format_time(song_length))
-                    self.current_time_label.config(text="0:00")
-                except:
-                    self.total_time_label.config(text="--:--")
-                
-            except Exception as e:
-                messagebox.showerror("Error", f"Could not play song: {str(e)}")
+    def show_mode(self):
+        if self.engine.is_shuffle:
+            self.shuffle_btn.config(bg="#e94560")
+            self.mode_label.config(text="⚖️ Smart Shuffle Mode" if self.engine.is_weighted else "🔀 Shuffle Mode")
+        else:
+            self.shuffle_btn.config(bg="#0f3460")
+            self.mode_label.config(text="📜 Sequential Mode")
+        self.gapless_btn.config(bg="#e94560" if self.engine.is_gapless else "#0f3460")
+        self.normalize_btn.config(bg="#e94560" if self.engine.normalize else "#0f3460")
+        self.weighted_btn.config(bg="#e94560" if self.engine.is_weighted else "#0f3460")
+        self.watch_btn.config(bg="#e94560" if self.engine.watching else "#0f3460")
+        if self.volume_scale.get() != round(self.engine.volume * 100):
+            self.volume_scale.set(round(self.engine.volume * 100))
     
-    def toggle_play_pause(self):
-        if self.playlist.size == 0:
-            messagebox.showwarning("No Songs", "Please load a folder with MP3 files first!")
+    def show_scan(self, data):
+        if not data['finished']:
+            if not self.scan_frame.winfo_ismapped():
+                self.scan_frame.pack(pady=(0, 10))
+                self.scan_bar.start(15)
+            if not self.engine.scanner.cancelled.is_set():
+                self.scan_label.config(text=f"Scanning... {data['songs']} songs")
             return
         
-        if self.is_playing and not self.is_paused:
-            pygame.mixer.music.pause()
-            self.is_paused = True
-            self.play_pause_btn.config(text="▶️ Play")
-        elif self.is_paused:
-            pygame.mixer.music.unpause()
-            self.is_paused = False
-            self.play_pause_btn.config(text="⏸️ Pause")
+        self.scan_bar.stop()
+        self.scan_frame.pack_forget()
+        
+        announce = self.announce_scan
+        self.announce_scan = False
+        if data['cancelled'] or not announce:
+            return
+        if data['songs'] == 0:
+            messagebox.showwarning("No MP3 Files", "No MP3 files found in the selected folder!")
         else:
-            song = self.playlist.get_current()
-            self.play_song(song)
-            self.play_pause_btn.config(text="⏸️ Pause")
+            messagebox.showinfo("Success", f"Loaded {data['songs']} MP3 files!")
     
-    def play_next(self):
-        if self.playlist.size == 0:
+    def toggle_play_pause(self):
+        if self.engine.playlist.size == 0:
+            messagebox.showwarning("No Songs", "Please load a folder with MP3 files first!")
             return
-            
-        if self.is_shuffle:
-            song = self.playlist.get_random_song()
-        else:
-            song = self.playlist.next_song()
         
-        if song:
-            self.play_song(song)
+        self.engine.toggle_pause()
+    
+    def play_next(self):
+        self.engine.play_next()
     
     def play_previous(self):
-        if self.playlist.size == 0:
-            return
-            
-        song = self.playlist.previous_song()
-        if song:
-            self.play_song(song)
+        self.engine.play_previous()
     
     def stop(self):
-        pygame.mixer.music.stop()
-        pygame.mixer.music.unload()
-        self.is_playing = False
-        self.is_paused = False
-        self.play_pause_btn.config(text="▶️ Play")
-        self.current_time_label.config(text="0:00")
-        self.total_time_label.config(text="0:00")
-        # Reset progress bar
-        self.progress_canvas.coords(self.progress_rect, 0, 0, 0, 6)
+        self.engine.stop()
     
     def toggle_shuffle(self):
-        self.is_shuffle = not self.is_shuffle
-        if self.is_shuffle:
-            self.shuffle_btn.config(bg="#e94560")
-            self.mode_label.config(text="🔀 Shuffle Mode")
-        else:
-            self.shuffle_btn.config(bg="#0f3460")
-            self.mode_label.config(text="📜 Sequential Mode")
+        self.engine.set_shuffle(not self.engine.is_shuffle)
     
-    def seek(self, value):
-        # Seeking disabled - progress bar is visual only
-        pass
+    def toggle_gapless(self):
+        self.engine.set_gapless(not self.engine.is_gapless)
+    
+    def toggle_weighted(self):
+        self.engine.set_weighted(not self.engine.is_weighted)
+    
+    def toggle_watch(self):
+        self.engine.set_watch(not self.engine.watching)
+    
+    def show_playlists(self):
+        self.playlist_choice.config(values=list(self.engine.playlists))
+        self.playlist_choice.set(self.engine.playlist_name)
+    
+    def on_playlist_chosen(self, event=None):
+        self.engine.switch_playlist(self.playlist_choice.get())
+    
+    def new_playlist(self):
+        name = simpledialog.askstring("New Playlist", "Name of the new playlist:", parent=self.root)
+        if not name:
+            return
+        try:
+            self.engine.create_playlist(name)
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+            return
+        # Empty to start with: load a folder or import an M3U into it
+        self.engine.switch_playlist(name.strip())
+    
+    def rename_playlist(self):
+        name = simpledialog.askstring(
+            "Rename Playlist", "New name:", initialvalue=self.engine.playlist_name, parent=self.root
+        )
+        if not name:
+            return
+        try:
+            self.engine.rename_playlist(self.engine.playlist_name, name.strip())
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+    
+    def delete_playlist(self):
+        name = self.engine.playlist_name
+        if len(self.engine.playlists) == 1:
+            messagebox.showwarning("Playlist", "The last playlist can't be deleted.")
+            return
+        if messagebox.askyesno("Delete Playlist", f"Delete the playlist \"{name}\"? The songs stay on disk."):
+            self.engine.delete_playlist(name)
+    
+    def toggle_favorite(self):
+        song = self.engine.current_song
+        if song:
+            self.engine.set_favorite(song, not song.favorite)
+    
+    def toggle_normalize(self):
+        self.engine.set_normalize(not self.engine.normalize)
+    
+    def change_volume(self, value):
+        self.engine.set_volume(int(value) / 100)
+    
+    def seek_target(self, event):
+        # Seconds under the pointer, or None when there is nothing to seek in
+        song = self.engine.current_song
+        width = self.progress_canvas.winfo_width()
+        if not self.engine.is_playing or not song or not song.duration or width <= 0:
+            return None
+        return song.duration * min(max(event.x / width, 0), 1)
+    
+    def drag_progress(self, event):
+        # While dragging only the bar and label follow, the jump happens on release
+        target = self.seek_target(event)
+        if target is None:
+            return
+        self.dragging = True
+        x = self.progress_canvas.winfo_width() * target / self.engine.current_song.duration
+        self.progress_canvas.coords(self.progress_rect, 0, 0, x, 6)
+        self.current_time_label.config(text=self.format_time(target))
+    
+    def release_progress(self, event):
+        target = self.seek_target(event)
+        self.dragging = False
+        self.shown_progress = None
+        if target is not None:
+            self.engine.seek(target)
+            self.update_progress()
+    
+    def schedule_pump(self):
+        # Only scheduled while the engine has work, nothing wakes up when idle or paused
+        if self.pump_job is None and self.engine.needs_pump():
+            self.pump_job = self.root.after(100, self.pump_events)
+    
+    def pump_events(self):
+        self.pump_job = None
+        self.engine.pump()
+        if self.engine.is_playing and not self.engine.is_paused:
+            self.update_progress()
+        self.schedule_pump()
     
     def update_progress(self):
-        if self.is_playing and not self.is_paused:
-            try:
-                # Check if music is still playing
-                if not pygame.mixer.music.get_busy():
-                    # Song ended, play next
-                    if self.is_playing:
-                        self.play_next()
-                else:
-                    # Minimal update - only time label, no canvas operations
-                    if self.current_song:
-                        try:
-                            current_pos = pygame.mixer.music.get_pos() / 1000
-                            if current_pos >= 0:
-                                self.current_time_label.config(text=self.format_time(current_pos))
-                        except:
-                            pass
-            except:
-                pass
+        if not self.engine.current_song or self.dragging:
+            return
+        
+        try:
+            current_pos = self.engine.position()
+        except RuntimeError:
+            # pygame.error
+            return
+        
+        # Only touch the widgets when the visible second or bar pixel changes
+        duration = self.engine.current_song.duration
+        width = self.progress_canvas.winfo_width()
+        x = int(width * min(current_pos / duration, 1)) if duration else 0
+        shown = (int(current_pos), x)
+        if shown == self.shown_progress:
+            return
         
-        # Update every 1000ms to reduce overhead
-        self.root.after(1000, self.update_progress)
+        self.shown_progress = shown
+        self.current_time_label.config(text=self.format_time(current_pos))
+        self.progress_canvas.coords(self.progress_rect, 0, 0, x, 6)
     
     def format_time(self, seconds):
         minutes = int(seconds // 60)
@@ -553,27 +4559,52 @@ class MusicPlayer:
         return f"{minutes}:{seconds:02d}"
     
     def update_display(self):
-        if self.current_song:
-            self.current_song_label.config(text=self.current_song.name)
+        song = self.engine.current_song
+        if song:
+            self.current_song_label.config(text=f"⭐ {song.name}" if song.favorite else song.name)
         else:
             self.current_song_label.config(text="No Song Selected")
+        self.favorite_btn.config(bg="#e94560" if song and song.favorite else "#0f3460")
     
     def show_playlist(self):
-        playlist_window = tk.Toplevel(self.root)
-        playlist_window.title("📜 Playlist")
-        playlist_window.geometry("600x400")
-        playlist_window.configure(bg="#1a1a2e")
+        # Built on first use, then only shown and hidden
+        if self.playlist_view is None:
+            with metrics.timer('ui.playlist_build'):
+                self.playlist_view = PlaylistView(self)
+        self.playlist_view.show()
+    
+    def show_recent(self):
+        # Built on first use, then refilled and shown again
+        if self.recent_window is None:
+            self.build_recent()
+        self.recent_listbox.delete(0, tk.END)
+        recent_songs = self.engine.recently_played.get_all()
+        if recent_songs:
+            for i, song in enumerate(recent_songs, 1):
+                self.recent_listbox.insert(tk.END, f"{i}. {song['name']}")
+        else:
+            self.recent_listbox.insert(tk.END, "No recently played songs")
+        self.recent_window.deiconify()
+        self.recent_window.lift()
+    
+    def build_recent(self):
+        recent_window = tk.Toplevel(self.root)
+        recent_window.title("🕒 Recently Played")
+        recent_window.geometry("600x400")
+        recent_window.configure(bg="#1a1a2e")
+        # Closing only hides the window, it is reused the next time
+        recent_window.protocol("WM_DELETE_WINDOW", recent_window.withdraw)
         
         title = tk.Label(
-            playlist_window,
-            text=f"📜 Playlist ({self.playlist.size} songs)",
+            recent_window,
+            text="🕒 Recently Played (Stack - LIFO)",
             font=("Arial", 14, "bold"),
             bg="#1a1a2e",
             fg="#e94560"
         )
         title.pack(pady=10)
         
-        frame = tk.Frame(playlist_window, bg="#16213e")
+        frame = tk.Frame(recent_window, bg="#16213e")
         frame.pack(fill=tk.BOTH, expand=True, padx=20, pady=10)
         
         scrollbar = tk.Scrollbar(frame)
@@ -592,89 +4623,136 @@ class MusicPlayer:
         listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         scrollbar.config(command=listbox.yview)
         
-        songs = self.playlist.get_all()
-        for i, song in enumerate(songs, 1):
-            status = "▶️ " if self.current_song and song['name'] == self.current_song.name else "   "
-            listbox.insert(tk.END, f"{status}{i}. {song['name']}")
-        
-        def play_selected(event):
-            selection = listbox.curselection()
-            if selection:
-                index = selection[0]
-                song_name = songs[index]['name']
-                song = self.playlist.find_song(song_name)
-                if song:
-                    self.play_song(song)
-                    self.play_pause_btn.config(text="⏸️ Pause")
-                    playlist_window.destroy()
-        
-        listbox.bind('<Double-Button-1>', play_selected)
-        
-        def remove_selected():
-            selection = listbox.curselection()
-            if selection:
-                index = selection[0]
-                song_name = songs[index]['name']
-                if messagebox.askyesno("Remove Song", f"Remove '{song_name}' from playlist?"):
-                    self.playlist.remove(song_name)
-                    self.stats_label.config(text=f"Songs in Playlist: {self.playlist.size}")
-                    playlist_window.destroy()
-        
-        remove_btn = tk.Button(
-            playlist_window,
-            text="🗑️ Remove Selected",
-            command=remove_selected,
-            font=("Arial", 10, "bold"),
-            bg="#e94560",
-            fg="white",
-            cursor="hand2"
-        )
-        remove_btn.pack(pady=10)
+        self.recent_window = recent_window
+        self.recent_listbox = listbox
     
-    def show_recent(self):
-        recent_window = tk.Toplevel(self.root)
-        recent_window.title("🕒 Recently Played")
-        recent_window.geometry("600x400")
-        recent_window.configure(bg="#1a1a2e")
+    def show_stats(self):
+        if self.stats_window is None:
+            self.build_stats()
+        self.refresh_stats()
+        self.stats_window.deiconify()
+        self.stats_window.lift()
+    
+    def build_stats(self):
+        stats_window = tk.Toplevel(self.root)
+        stats_window.title("📊 Playback Stats")
+        stats_window.geometry("760x420")
+        stats_window.configure(bg="#1a1a2e")
+        stats_window.protocol("WM_DELETE_WINDOW", stats_window.withdraw)
         
         title = tk.Label(
-            recent_window,
-            text="🕒 Recently Played (Stack - LIFO)",
+            stats_window,
+            text="📊 Latency (ms) since startup",
             font=("Arial", 14, "bold"),
             bg="#1a1a2e",
             fg="#e94560"
         )
         title.pack(pady=10)
         
-        frame = tk.Frame(recent_window, bg="#16213e")
-        frame.pack(fill=tk.BOTH, expand=True, padx=20, pady=10)
-        
-        scrollbar = tk.Scrollbar(frame)
-        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        columns = ('count', 'mean', 'p50', 'p95', 'p99', 'max')
+        tree = ttk.Treeview(stats_window, columns=columns, height=14)
+        tree.heading('#0', text="Timer")
+        tree.column('#0', width=180)
+        for column in columns:
+            tree.heading(column, text=column)
+            tree.column(column, width=90, anchor=tk.E)
+        tree.pack(fill=tk.BOTH, expand=True, padx=20)
         
-        listbox = tk.Listbox(
-            frame,
-            yscrollcommand=scrollbar.set,
-            font=("Arial", 11),
-            bg="#16213e",
+        counters = tk.Label(
+            stats_window,
+            font=("Arial", 10),
+            bg="#1a1a2e",
             fg="#f1f1f1",
-            selectbackground="#e94560",
-            selectforeground="white",
-            height=15
+            justify=tk.LEFT
         )
-        listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-        scrollbar.config(command=listbox.yview)
+        counters.pack(pady=5)
         
-        recent_songs = self.recently_played.get_all()
-        if recent_songs:
-            for i, song in enumerate(recent_songs, 1):
-                listbox.insert(tk.END, f"{i}. {song['name']}")
-        else:
-            listbox.insert(tk.END, "No recently played songs")
+        refresh_btn = tk.Button(
+            stats_window,
+            text="🔄 Refresh",
+            command=self.refresh_stats,
+            font=("Arial", 10),
+            bg="#0f3460",
+            fg="white",
+            cursor="hand2"
+        )
+        refresh_btn.pack(pady=5)
+        
+        self.stats_window = stats_window
+        self.stats_tree = tree
+        self.stats_counters = counters
+    
+    def refresh_stats(self):
+        snapshot = metrics.snapshot()
+        self.stats_tree.delete(*self.stats_tree.get_children())
+        for name, timer in snapshot['timers'].items():
+            self.stats_tree.insert('', tk.END, text=name, values=(
+                timer['count'], timer['mean_ms'], timer['p50_ms'],
+                timer['p95_ms'], timer['p99_ms'], timer['max_ms'],
+            ))
+        self.stats_counters.config(text="   ".join(f"{name}: {value}" for name, value in snapshot['counters'].items()))
 
 def main():
-    root = tk.Tk()
-    app = MusicPlayer(root)
+    parser = argparse.ArgumentParser(description="Pysic music player")
+    parser.add_argument('--headless', action='store_true',
+                        help="run without a window, driven only through the control socket")
+    parser.add_argument('--socket', nargs='?', const=DEFAULT_SOCKET, metavar='PATH',
+                        help="serve the JSON-lines control socket (default: %(const)s)")
+    parser.add_argument('--send', metavar='JSON',
+                        help="send one request to a running player and print the reply")
+    parser.add_argument('--history-size', type=int, default=1000, metavar='N',
+                        help="how many recently played songs to keep (default: %(default)s)")
+    parser.add_argument('--cache-mb', type=int, default=96, metavar='MB',
+                        help="memory for cached audio files (default: %(default)s)")
+    parser.add_argument('--startup-report', action='store_true',
+                        help="print how long each startup step took to stderr")
+    args = parser.parse_args()
+    
+    if args.send:
+        print(send_request(args.socket or DEFAULT_SOCKET, args.send))
+        return
+    
+    # Timings gathered during the session are kept for later comparison
+    atexit.register(metrics.dump, os.path.join(DATA_DIR, 'metrics.json'))
+    
+    # Tracks load on a worker thread, the host loop only starts them
+    engine_options = {
+        'history_size': args.history_size,
+        'cache_bytes': args.cache_mb * 1024 * 1024,
+        'background_loads': True,
+    }
+    
+    if args.headless:
+        # No display needed; pygame still wants a video driver to deliver events
+        os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+        with metrics.timer('startup.engine'):
+            engine = PlayerEngine(**engine_options)
+        # The playlist as it stands on exit is what the next start restores
+        atexit.register(engine.autosave)
+        with metrics.timer('startup.restore'):
+            engine.restore()
+        # pygame loads in the background, the mixer itself starts with the first song
+        on_ready = None
+        if args.startup_report:
+            on_ready = lambda: print(startup_report(), file=sys.stderr)
+        engine.warm_up(on_ready)
+        try:
+            asyncio.run(ControlServer(engine, args.socket or DEFAULT_SOCKET).serve())
+        except KeyboardInterrupt:
+            pass
+        except OSError as e:
+            sys.exit(f"Could not serve the control socket: {e}")
+        return
+    
+    with metrics.timer('startup.tk'):
+        root = tk.Tk()
+    with metrics.timer('startup.engine'):
+        engine = PlayerEngine(**engine_options)
+    atexit.register(engine.autosave)
+    app = MusicPlayer(root, engine, startup_report=args.startup_report)
+    if args.socket:
+        # The server thread hands each request to the Tk thread, which runs the engine
+        ControlServer(app.engine, args.socket, call_soon=app.call_soon).start_thread()
     root.mainloop()
 
 if __name__ == "__main__":
@@ -0,0 +1,333 @@
+# Benchmarks for the playlist/history data structures and the playback path.
+# Needs no display; playback runs against SDL's dummy audio driver.
+#
+#   python benchmark.py                       # 10^3 .. 10^6 elements, JSON on stdout
+#   python benchmark.py --sizes 1000 10000 --output before.json
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import wave
+
+# Keep the benchmark away from the real library index and sound card
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ['PYSIC_HOME'] = tempfile.mkdtemp(prefix='pysic-bench-')
+
+import app
+
+# How many operations the per-op benchmarks run, whatever the list size
+SAMPLE_OPS = 1000
+
+class Results:
+    def __init__(self):
+        self.rows = []
+    
+    def record(self, name, n, ops, seconds, **extra):
+        row = {
+            'name': name,
+            'n': n,
+            'ops': ops,
+            'seconds': round(seconds, 6),
+            'per_op_us': round(seconds / ops * 1e6, 3) if ops else None,
+        }
+        row.update(extra)
+        self.rows.append(row)
+        print(f"{name:<28} n={n:<8} ops={ops:<8} {row['per_op_us']} us/op", file=sys.stderr)
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+def build_playlist(n):
+    playlist = app.CircularDoublyLinkedList()
+    for i in range(n):
+        playlist.add(f"song {i}", f"/music/album {i // 12}/song {i}.mp3")
+    return playlist
+
+def bench_playlist(results, n):
+    paths = [f"/music/album {i // 12}/song {i}.mp3" for i in range(n)]
+    sample = random.sample(paths, min(SAMPLE_OPS, n))
+    
+    seconds, playlist = timed(build_playlist, n)
+    results.record('cdll.add', n, n, seconds)
+    
+    seconds, _ = timed(lambda: [playlist.find_song(p) for p in sample])
+    results.record('cdll.find_song', n, len(sample), seconds)
+    
+    # The first search builds the trigram index, later ones only query it
+    queries = [os.path.basename(p)[:-4][-4:] for p in sample]
+    seconds, _ = timed(playlist.search, queries[0])
+    results.record('cdll.search_index_build', n, n, seconds)
+    
+    seconds, _ = timed(lambda: [playlist.search(q, 100) for q in queries])
+    results.record('cdll.search', n, len(queries), seconds)
+    
+    seconds, _ = timed(lambda: [playlist.get_random_song() for _ in range(SAMPLE_OPS)])
+    results.record('cdll.get_random_song', n, SAMPLE_OPS, seconds)
+    
+    # Weighted shuffle: Fenwick tree built over the playlist, then sampled and updated
+    seconds, _ = timed(playlist.set_weighted, True)
+    results.record('cdll.weighted_build', n, n, seconds)
+    
+    seconds, _ = timed(lambda: [playlist.get_random_song() for _ in range(SAMPLE_OPS)])
+    results.record('cdll.get_random_song_weighted', n, SAMPLE_OPS, seconds)
+    
+    nodes = [playlist.get(p) for p in sample]
+    def rate():
+        for node in nodes:
+            node.plays += 1
+            node.skips += 1
+            playlist.weights.update(node)
+    seconds, _ = timed(rate)
+    results.record('cdll.weight_update', n, len(nodes), seconds)
+    playlist.set_weighted(False)
+    
+    seconds, _ = timed(lambda: [playlist.next_song() for _ in range(SAMPLE_OPS)])
+    results.record('cdll.next_song', n, SAMPLE_OPS, seconds)
+    
+    seconds, _ = timed(lambda: [playlist.previous_song() for _ in range(SAMPLE_OPS)])
+    results.record('cdll.previous_song', n, SAMPLE_OPS, seconds)
+    
+    seconds, songs = timed(playlist.get_all)
+    results.record('cdll.get_all', n, len(songs), seconds)
+    
+    seconds, _ = timed(lambda: [playlist.remove(p) for p in sample])
+    results.record('cdll.remove', n, len(sample), seconds)
+    
+    # Batch operations: one linking pass, one removal sweep, in-place merge sort
+    songs = [(f"song {i}", path) for i, path in enumerate(paths)]
+    batch = app.CircularDoublyLinkedList()
+    seconds, _ = timed(batch.extend, songs)
+    results.record('cdll.extend', n, n, seconds)
+    
+    for node in batch:
+        node.duration = random.random() * 600
+    seconds, _ = timed(batch.sort, lambda node: node.duration)
+    results.record('cdll.sort_duration', n, n, seconds)
+    
+    seconds, _ = timed(batch.sort, lambda node: node.name.lower())
+    results.record('cdll.sort_name', n, n, seconds)
+    
+    seconds, _ = timed(batch.remove_many, sample)
+    results.record('cdll.remove_many', n, len(sample), seconds)
+
+def bench_persistence(results, n):
+    # Binary snapshot and M3U, both ways
+    playlist = build_playlist(n)
+    for node in playlist:
+        node.duration = random.random() * 600
+    snapshot_path = os.path.join(os.environ['PYSIC_HOME'], 'bench.bin')
+    m3u_path = os.path.join(os.environ['PYSIC_HOME'], 'bench.m3u8')
+    
+    seconds, _ = timed(app.save_snapshot, snapshot_path, {'bench': playlist}, {})
+    results.record('snapshot.save', n, n, seconds, bytes=os.path.getsize(snapshot_path))
+    
+    seconds, _ = timed(app.load_snapshot, snapshot_path)
+    results.record('snapshot.load', n, n, seconds)
+    
+    seconds, _ = timed(app.write_m3u, m3u_path, playlist)
+    results.record('m3u.export', n, n, seconds)
+    
+    seconds, _ = timed(lambda: app.CircularDoublyLinkedList().extend(
+        (name, path) for name, path, duration in app.read_m3u(m3u_path)))
+    results.record('m3u.import', n, n, seconds)
+
+def allocated(fn, *args):
+    # Bytes still held by what fn allocated, kept alive by its result
+    tracemalloc.start()
+    try:
+        result = fn(*args)
+        return tracemalloc.get_traced_memory()[0], result
+    finally:
+        tracemalloc.stop()
+
+def bench_playlists(results, n):
+    # A second playlist over the same songs: shared track records or copies
+    songs = [(f"song {i}", f"/music/album {i // 12}/song {i}.mp3") for i in range(n)]
+    tracks = app.TrackTable()
+    app.CircularDoublyLinkedList(tracks).extend(songs)
+    
+    seconds, _ = timed(lambda: app.CircularDoublyLinkedList(tracks).extend(songs))
+    results.record('playlists.second_shared', n, n, seconds)
+    
+    shared, _ = allocated(lambda: app.CircularDoublyLinkedList(tracks).extend(songs))
+    copied, _ = allocated(lambda: app.CircularDoublyLinkedList().extend(songs))
+    results.record('playlists.memory', n, 0, 0.0, shared_bytes=shared, copied_bytes=copied)
+    
+    # Switching back and forth, each keeps its cursor and shuffle state
+    engine = app.PlayerEngine()
+    engine.add_tracks([(name, path, None) for name, path in songs])
+    engine.create_playlist('other', [path for name, path in songs])
+    names = ['other', app.DEFAULT_PLAYLIST] * (SAMPLE_OPS // 2)
+    seconds, _ = timed(lambda: [engine.switch_playlist(name) for name in names])
+    results.record('playlists.switch', n, len(names), seconds)
+
+def bench_stack(results, n):
+    stack = app.Stack(n)
+    for i in range(n):
+        stack.push({'name': f"song {i}", 'path': f"/music/song {i}.mp3"})
+    
+    # Every push now evicts the oldest entry
+    seconds, _ = timed(lambda: [stack.push({'name': 'x', 'path': '/x.mp3'}) for _ in range(SAMPLE_OPS)])
+    results.record('stack.push_at_max_size', n, SAMPLE_OPS, seconds)
+    
+    seconds, items = timed(stack.get_all)
+    results.record('stack.get_all', n, len(items), seconds)
+
+def bench_metrics(results):
+    # What instrumenting a hot path costs per timed block
+    metrics = app.Metrics()
+    def run():
+        for _ in range(SAMPLE_OPS * 100):
+            with metrics.timer('bench'):
+                pass
+    seconds, _ = timed(run)
+    results.record('metrics.timer', 1, SAMPLE_OPS * 100, seconds)
+
+def write_silent_mp3(path, seconds):
+    # MPEG-1 Layer III, 128 kbps, 44.1 kHz; all-zero side info decodes to silence
+    header = bytes([0xFF, 0xFB, 0x90, 0x44])
+    frame = header + bytes(app.parse_frame_header(header, 0)[0] - 4)
+    with open(path, 'wb') as f:
+        f.write(frame * int(seconds * 44100 / 1152))
+
+def write_silent_wav(path, seconds):
+    with wave.open(path, 'wb') as w:
+        w.setnchannels(2)
+        w.setsampwidth(2)
+        w.setframerate(44100)
+        w.writeframes(bytes(int(seconds * 44100) * 4))
+
+def make_fixtures(folder, count, seconds):
+    os.makedirs(folder, exist_ok=True)
+    for i in range(count):
+        write_silent_mp3(os.path.join(folder, f"track {i:05d}.mp3"), seconds)
+    write_silent_wav(os.path.join(folder, "silence.wav"), seconds)
+
+def load_library(engine, folder):
+    engine.load(folder)
+    while engine.scanner:
+        engine.pump()
+        time.sleep(0.001)
+
+def bench_watch(results, count, seconds):
+    # Watch mode: a poll that finds nothing, then one after a single new file
+    folder = os.path.join(os.environ['PYSIC_HOME'], 'watched')
+    for i in range(count):
+        album = os.path.join(folder, f"album {i // 10:04d}")
+        os.makedirs(album, exist_ok=True)
+        write_silent_mp3(os.path.join(album, f"track {i:05d}.mp3"), seconds)
+    # Old enough that no folder counts as just changed
+    stale = time.time() - 60
+    for album in os.listdir(folder):
+        os.utime(os.path.join(folder, album), (stale, stale))
+    os.utime(folder, (stale, stale))
+    
+    library = app.LibraryIndex(os.path.join(os.environ['PYSIC_HOME'], 'watch.db'))
+    scanner = app.FolderScanner(folder, library)
+    scanner.scan()
+    watcher = app.FolderWatcher(folder, library, scanner.tree)
+    db = library.connect()
+    
+    elapsed, _ = timed(watcher.poll, db)
+    results.record('watch.poll_idle', count, len(watcher.tree), elapsed)
+    
+    write_silent_mp3(os.path.join(folder, "album 0000", "new.mp3"), seconds)
+    elapsed, _ = timed(watcher.poll, db)
+    results.record('watch.poll_one_change', count, len(watcher.tree), elapsed, changes=watcher.changes.qsize())
+    db.close()
+
+def bench_playback(results, count, seconds):
+    try:
+        import pygame
+    except ImportError:
+        results.record('playback', count, 0, 0.0, skipped="pygame not installed")
+        return
+    
+    # Startup: the engine alone, then the mixer it defers to the first song
+    elapsed, engine = timed(app.PlayerEngine)
+    results.record('startup.engine', 1, 1, elapsed)
+    elapsed, _ = timed(engine.init_mixer)
+    results.record('startup.init_mixer', 1, 1, elapsed)
+    
+    folder = os.path.join(os.environ['PYSIC_HOME'], 'fixtures')
+    make_fixtures(folder, count, seconds)
+    
+    # Cold: empty library index, every header gets read
+    engine = app.PlayerEngine()
+    elapsed, _ = timed(load_library, engine, folder)
+    results.record('load_folder.cold', count, count, elapsed)
+    
+    # Warm: a fresh engine over the same index only diffs size/mtime
+    engine = app.PlayerEngine(engine.library)
+    elapsed, _ = timed(load_library, engine, folder)
+    results.record('load_folder.warm', count, count, elapsed)
+    
+    songs = [engine.playlist.find_song(p['path']) for p in engine.playlist.get_all()]
+    elapsed, _ = timed(lambda: [engine.play_song(song) for song in songs])
+    results.record('play_song.mp3', count, len(songs), elapsed)
+    
+    # Second round: every file is in the audio cache by now
+    elapsed, _ = timed(lambda: [engine.play_song(song) for song in songs])
+    results.record('play_song.mp3_cached', count, len(songs), elapsed, cache=engine.cache.stats())
+    
+    wav = app.SongNode(app.Track('silence', os.path.join(folder, 'silence.wav')))
+    elapsed, _ = timed(lambda: [engine.play_song(wav) for _ in range(20)])
+    results.record('play_song.wav', 1, 20, elapsed)
+    
+    # Loudness analysis of the whole folder across a process pool
+    if not app.numpy_available():
+        results.record('loudness.analyze', count, 0, 0.0, skipped="numpy not installed")
+    else:
+        analyzer = app.LoudnessAnalyzer(folder, engine.library)
+        elapsed, _ = timed(analyzer.run)
+        results.record('loudness.analyze', count, count, elapsed, workers=analyzer.workers)
+    
+    engine.stop()
+    pygame.mixer.quit()
+    results.record('playback.metrics', count, 0, 0.0, metrics=app.metrics.snapshot())
+
+def main():
+    parser = argparse.ArgumentParser(description="Pysic benchmarks, JSON results on stdout")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6])
+    parser.add_argument('--tracks', type=int, default=200, help="generated MP3 fixtures for the playback run")
+    parser.add_argument('--track-seconds', type=float, default=5.0)
+    parser.add_argument('--skip-playback', action='store_true')
+    parser.add_argument('--output', help="write the JSON here instead of stdout")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    
+    random.seed(args.seed)
+    results = Results()
+    for n in args.sizes:
+        bench_playlist(results, n)
+        bench_persistence(results, n)
+        bench_playlists(results, n)
+        bench_stack(results, n)
+    bench_metrics(results)
+    bench_watch(results, args.tracks, 0.1)
+    if not args.skip_playback:
+        bench_playback(results, args.tracks, args.track_seconds)
+    
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results.rows,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import os
+import sys
+import tempfile
+import unittest
+
+# The player keeps its index, history and snapshot under PYSIC_HOME
+os.environ['PYSIC_HOME'] = tempfile.mkdtemp()
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app
+
+# Regression tests for engine bookkeeping that needs no mixer or window
+class StatsTest(unittest.TestCase):
+    def setUp(self):
+        home = tempfile.mkdtemp()
+        self.engine = app.PlayerEngine(library=app.LibraryIndex(os.path.join(home, 'library.db')))
+        self.path = '/music/a/song.mp3'
+    
+    def stored_plays(self):
+        rows = self.engine.library.file_play_stats([self.path])
+        return rows[0][1] if rows else None
+    
+    def load_song(self):
+        self.engine.add_tracks([('song', self.path, None)])
+        self.engine.apply_stats(self.engine.library.file_play_stats([self.path]))
+        return self.engine.playlist.get(self.path)
+    
+    def play(self, node):
+        node.plays += 1
+        self.engine.save_stats(node)
+    
+    def test_unsaved_stats_survive_prune_and_recreate(self):
+        self.engine.library.save_play_stats([(self.path, 10, 0, 0)])
+        self.play(self.load_song())
+        # Another folder replaces the playlist before the deferred save ran
+        self.engine.replace_playlist(app.CircularDoublyLinkedList(self.engine.tracks))
+        self.assertIsNone(self.engine.tracks.get(self.path))
+        self.engine.replace_playlist(app.CircularDoublyLinkedList(self.engine.tracks))
+        node = self.load_song()
+        self.assertEqual(node.plays, 11)
+        self.play(node)
+        self.engine.autosave()
+        self.assertEqual(self.stored_plays(), 12)
+    
+    def test_added_file_gets_indexed_stats_and_gain(self):
+        db = self.engine.library.db
+        with db:
+            db.execute("INSERT INTO tracks VALUES (?, 'song', 1, 5, 100.0)", (self.path,))
+            db.execute("INSERT INTO loudness VALUES (?, 5, -20.0, 0.5, -3.0)", (self.path,))
+        self.engine.library.save_play_stats([(self.path, 7, 2, 1)])
+        self.engine.library_playlist = self.engine.playlist
+        # The watcher found the file back in the folder
+        self.engine.apply_change('add', [('song', self.path, 100.0)])
+        node = self.engine.playlist.get(self.path)
+        self.assertEqual((node.plays, node.skips, node.favorite, node.gain), (7, 2, True, -3.0))
+
+class ShuffleHistoryTest(unittest.TestCase):
+    def setUp(self):
+        # A, B and C played in that order, then Previous went back to B
+        self.playlist = app.CircularDoublyLinkedList(app.TrackTable())
+        self.nodes = {name: self.playlist.add(name, f'/music/{name}.mp3') for name in 'ABCDE'}
+        self.shuffle = self.playlist.shuffle
+        for name in 'ABC':
+            self.shuffle.played(self.nodes[name])
+        self.assertIs(self.shuffle.previous(), self.nodes['B'])
+    
+    def remove(self, name, compact):
+        self.playlist.remove(f'/music/{name}.mp3')
+        if compact:
+            self.shuffle.compact()
+    
+    def test_remove_before_position(self):
+        for compact in (False, True):
+            with self.subTest(compact=compact):
+                self.setUp()
+                self.remove('A', compact)
+                self.assertIs(self.shuffle.peek(), self.nodes['C'])
+                self.assertIsNone(self.shuffle.previous())
+                self.assertIs(self.shuffle.next(), self.nodes['C'])
+    
+    def test_remove_at_position(self):
+        for compact in (False, True):
+            with self.subTest(compact=compact):
+                self.setUp()
+                self.remove('B', compact)
+                # A is the last song left that played, nothing comes before it
+                self.assertIsNone(self.shuffle.previous())
+                self.assertIs(self.shuffle.next(), self.nodes['C'])
+                self.assertIs(self.shuffle.previous(), self.nodes['A'])
+    
+    def test_remove_first_entry_at_position(self):
+        for compact in (False, True):
+            with self.subTest(compact=compact):
+                self.setUp()
+                self.assertIs(self.shuffle.previous(), self.nodes['A'])
+                self.remove('A', compact)
+                # B hasn't played since going back, it is still ahead
+                self.assertIs(self.shuffle.next(), self.nodes['B'])
+                self.assertIs(self.shuffle.next(), self.nodes['C'])
+    
+    def test_remove_after_position(self):
+        for compact in (False, True):
+            with self.subTest(compact=compact):
+                self.setUp()
+                self.remove('C', compact)
+                self.assertIn(self.shuffle.next(), (self.nodes['D'], self.nodes['E']))
+                self.assertIs(self.shuffle.previous(), self.nodes['B'])
+                self.assertIs(self.shuffle.previous(), self.nodes['A'])
+
+if __name__ == '__main__':
+    unittest.main()